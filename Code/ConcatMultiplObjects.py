@@ -10,6 +10,10 @@ If no merge plan is found or if it's empty, the user is prompted to define one i
 Usage:
     python ConcatMultiplObjects.py --prepared_json /path/to/PreparedSegmentations_info.json [--merge_plan /path/to/merge_plan.json]
 
+The PREPARED_JSON and MERGE_PLAN environment variables are used when the matching argument
+is not given. When stdin is not a terminal (batch/pipeline runs), the script exits with an
+error instead of waiting for input it will never get.
+
 Example merge_plan.json structure:
 {
   "merge_plan": {
@@ -26,17 +30,39 @@ Example merge_plan.json structure:
   }
 }
 
+Storage format of the updated pickles:
+  - For BINARY segmentations every frame's 2D mask is packed with np.packbits (1 bit per
+    pixel) and its original (rows, cols) is kept in "pixel_shape". The pickle is flagged
+    with "pixel_encoding": "packbits" so readers know to unpack. Other types (e.g.
+    FRACTIONAL) keep their frames unpacked, and merged frames are added as 0/1 masks.
+  - The pickle is written gzip-compressed (level 1); readers detect this from the gzip
+    magic bytes, so plain pickles from older runs keep working.
+  - Frames stay plain dicts rather than dataclass/namedtuple instances: every other script
+    reads them with fr.get(...), and a class defined in a script is pickled as
+    __main__.<ClassName>, which the other scripts could not unpickle.
+
 Author: YourName
 Date: YYYY-MM-DD
 """
 
 import os
 import sys
+import gzip
 import json
 import pickle
 import argparse
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None  # optional; the merge falls back to NumPy's bitwise_or.reduceat
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then written with the stdlib json module
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Merge segmentation objects based on a merge plan."
@@ -51,6 +77,156 @@ def parse_args():
     )
     return parser.parse_args()
 
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+def load_pickle(pkl_path):
+    """
+    Load a segmentation pickle. Handles both plain pickles and the gzip-compressed
+    pickles written by Step_2_3 and ConcatMultiplObjects (detected by the gzip magic bytes).
+    """
+    with open(pkl_path, "rb") as pf:
+        magic = pf.read(2)
+        pf.seek(0)
+        if magic == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=pf, mode="rb") as gz:
+                return pickle.load(gz)
+        return pickle.load(pf)
+
+def pack_mask(mask):
+    """
+    Pack a binary 2D mask into a flat uint8 bitmap (8 pixels per byte).
+
+    Returns:
+        (np.ndarray, tuple): The packed bitmap and the original (rows, cols) shape.
+    """
+    mask = np.asarray(mask)
+    return np.packbits(mask.ravel()), tuple(mask.shape)
+
+def unpack_mask(packed, shape):
+    """
+    Inverse of pack_mask: rebuild the 0/1 uint8 mask of the given (rows, cols) shape.
+    """
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _or_reduce_kernel(stack, offsets, out, nonempty):
+        # stack: (n_masks, n_words) packed masks, sorted so each group is contiguous.
+        # Group g covers rows offsets[g]:offsets[g + 1] and is OR-ed into out[g].
+        # The emptiness test is fused in: OR-ing every written word gives the
+        # OR of the final mask, so nonempty[g] needs no second pass.
+        for g in prange(offsets.shape[0] - 1):
+            acc = 0
+            for j in range(offsets[g], offsets[g + 1]):
+                for b in range(stack.shape[1]):
+                    v = out[g, b] | stack[j, b]
+                    out[g, b] = v
+                    acc |= v
+            nonempty[g] = acc != 0
+
+def or_reduce(stack, offsets):
+    """
+    OR-reduce groups of packed masks in one call.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        (n_masks, n_bytes) uint8 array of packed masks, grouped contiguously.
+    offsets : np.ndarray
+        int64 array of length n_groups + 1; group g is stack[offsets[g]:offsets[g + 1]].
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        (n_groups, n_bytes) uint8 array with one merged mask per group, and a
+        boolean array telling which merged masks have any pixel set.
+    """
+    # SWAR: when the row length allows it, OR 8 bytes per operation through a uint64 view
+    wide = stack.shape[1] % 8 == 0 and stack.flags.c_contiguous
+    work = stack.view(np.uint64) if wide else stack
+    if njit is None:
+        out = np.bitwise_or.reduceat(work, offsets[:-1], axis=0)
+        nonempty = out.any(axis=1)
+    else:
+        out = np.zeros((len(offsets) - 1, work.shape[1]), dtype=work.dtype)
+        nonempty = np.zeros(len(offsets) - 1, dtype=np.bool_)
+        _or_reduce_kernel(work, offsets, out, nonempty)
+    return (out.view(np.uint8) if wide else out), nonempty
+
+def position_key(ipp):
+    """
+    Hashable form of an ImagePositionPatient value (None if missing).
+    The usual 3-value case is built directly instead of iterating with tuple().
+    """
+    if not ipp:
+        return None
+    if len(ipp) == 3:
+        return (ipp[0], ipp[1], ipp[2])
+    return tuple(ipp)
+
+def frames_to_arrays(frames, name_ids, key_codes, packed=True, reserve_groups=0):
+    """
+    Structure-of-arrays view of the frame fields used by the merge.
+
+    Segment names and (ref_sop_uid, image_position_patient) slice keys are factorized
+    to integer codes so that selecting and grouping frames are plain NumPy operations.
+    name_ids and key_codes map names / slice keys to codes and are extended in place.
+    With packed=False the frames hold unpacked 2D masks (e.g. FRACTIONAL segmentations);
+    the stack then gets a packed binarized copy (pixel > 0) and the frames are not changed.
+    reserve_groups leaves room in the stack buffer for that many merge results of up to
+    one row per slice key each; "pixel_data" is then a view of the first n_frames rows of
+    that buffer (its .base), so merged rows can be appended in place.
+
+    Returns
+    -------
+    dict
+        "name_id" (int64), "key_code" (int64, -1 for frames without pixel data or
+        reference UID, which cannot be merged), "pixel_data" (n_frames, n_bytes) uint8
+        stack of the packed masks and "pixel_shape" (object array of (rows, cols)).
+    """
+    n = len(frames)
+    arrays = {
+        "name_id": np.empty(n, dtype=np.int64),
+        "key_code": np.full(n, -1, dtype=np.int64),
+        "pixel_data": None,
+        "pixel_shape": np.empty(n, dtype=object),
+    }
+    rows = {}
+    for i, fr in enumerate(frames):
+        arrays["name_id"][i] = name_ids.setdefault(fr.get("segment_name"), len(name_ids))
+        ref_sop_uid = fr.get("ref_sop_uid")
+        if fr.get("pixel_data") is None or ref_sop_uid is None:
+            continue
+        key = (ref_sop_uid, position_key(fr.get("image_position_patient")))
+        arrays["key_code"][i] = key_codes.setdefault(key, len(key_codes))
+        if packed:
+            rows[i] = fr["pixel_data"]
+            arrays["pixel_shape"][i] = fr.get("pixel_shape")
+        else:
+            rows[i], arrays["pixel_shape"][i] = pack_mask(np.asarray(fr["pixel_data"]) > 0)
+    width = len(next(iter(rows.values()))) if rows else 0
+    stack = np.zeros((n + reserve_groups * len(key_codes), width), dtype=np.uint8)
+    for i, row in rows.items():
+        stack[i] = row
+    arrays["pixel_data"] = stack[:n]
+    return arrays
+
+def prompt(msg):
+    """
+    input() for interactive runs. When stdin is not a terminal, exit with an error
+    instead of blocking forever.
+    """
+    if not sys.stdin.isatty():
+        sys.exit(f"[ERROR] Input required but stdin is not interactive: {msg.strip()}")
+    return input(msg)
+
 def define_merge_plan_interactively():
     """
     Interactively ask the user to define a merge plan.
@@ -62,15 +238,15 @@ def define_merge_plan_interactively():
     """
     merge_plan = {}
     print("\nNo merge plan found. Would you like to define one interactively? (y/n)")
-    resp = input(">> ").strip().lower()
+    resp = prompt(">> ").strip().lower()
     if resp != "y":
         return merge_plan  # empty
 
     print("Do you want to define a global merge plan for all segmentations? (y/n)")
-    global_resp = input(">> ").strip().lower()
+    global_resp = prompt(">> ").strip().lower()
     if global_resp == "y":
-        old_objs_input = input("Enter old segmentation object names to merge (comma-separated): ").strip()
-        new_obj = input("Enter new segmentation object name: ").strip()
+        old_objs_input = prompt("Enter old segmentation object names to merge (comma-separated): ").strip()
+        new_obj = prompt("Enter new segmentation object name: ").strip()
         if old_objs_input and new_obj:
             merge_plan["all"] = [
                 {
@@ -81,11 +257,11 @@ def define_merge_plan_interactively():
     else:
         print("Now, enter merge directives for specific segmentation folders.")
         while True:
-            seg_key = input("Enter segmentation folder key (or leave blank to finish): ").strip()
+            seg_key = prompt("Enter segmentation folder key (or leave blank to finish): ").strip()
             if not seg_key:
                 break
-            old_objs_input = input(f"Enter old segmentation object names for {seg_key} (comma-separated): ").strip()
-            new_obj = input(f"Enter new segmentation object name for {seg_key}: ").strip()
+            old_objs_input = prompt(f"Enter old segmentation object names for {seg_key} (comma-separated): ").strip()
+            new_obj = prompt(f"Enter new segmentation object name for {seg_key}: ").strip()
             if old_objs_input and new_obj:
                 merge_plan.setdefault(seg_key, []).append({
                     "old_objects": [x.strip() for x in old_objs_input.split(",") if x.strip()],
@@ -98,15 +274,13 @@ def define_merge_plan_interactively():
 def main():
     args = parse_args()
     
-    # Determine paths
-    if not args.prepared_json:
-        prepared_json_path = input("Please provide the path to PreparedSegmentations_info.json: ").strip()
-    else:
-        prepared_json_path = args.prepared_json
+    # Determine paths (command line first, then environment, then ask)
+    prepared_json_path = args.prepared_json or os.environ.get("PREPARED_JSON")
+    if not prepared_json_path:
+        prepared_json_path = prompt("Please provide the path to PreparedSegmentations_info.json: ").strip()
 
-    if args.merge_plan:
-        merge_plan_path = args.merge_plan
-    else:
+    merge_plan_path = args.merge_plan or os.environ.get("MERGE_PLAN")
+    if not merge_plan_path:
         merge_plan_path = os.path.join(os.path.dirname(os.path.abspath(prepared_json_path)), "merge_plan.json")
 
     if not os.path.exists(prepared_json_path):
@@ -133,8 +307,7 @@ def main():
         merge_plan = define_merge_plan_interactively()
         if merge_plan:
             # Optionally, save the new merge plan to merge_plan.json for future use.
-            with open(merge_plan_path, "w") as f:
-                json.dump({"merge_plan": merge_plan}, f, indent=4)
+            write_json({"merge_plan": merge_plan}, merge_plan_path)
             print(f"[INFO] Saved new merge plan to {merge_plan_path}")
         else:
             print("No merge plan defined. Exiting.")
@@ -160,16 +333,41 @@ def main():
         print(f"\n[INFO] Processing merges for {seg_folder_name} (pkl: {pkl_file_path})")
 
         # Load the segmentation pickle
-        with open(pkl_file_path, "rb") as pf:
-            seg_data = pickle.load(pf)
+        seg_data = load_pickle(pkl_file_path)
         frames = seg_data.get("frames", [])
         if not isinstance(frames, list):
             print(f"[ERROR] 'frames' is not a list in {pkl_file_path}. Skipping.")
             continue
 
+        # Convert BINARY frames to packed bitmaps once; merging then works on the packed
+        # bytes. Other types (FRACTIONAL keeps 0-255 values) stay as they are, and only
+        # binarized copies of their masks are packed for the merge.
+        is_packed = seg_data.get("pixel_encoding") == "packbits"
+        if not is_packed and str(seg_data.get("segmentation_type", "")).upper() == "BINARY":
+            for fr in frames:
+                if fr.get("pixel_data") is not None:
+                    fr["pixel_data"], fr["pixel_shape"] = pack_mask(fr["pixel_data"])
+            seg_data["pixel_encoding"] = "packbits"
+            is_packed = True
+
         # Determine new segment_number (max existing + 1)
-        existing_seg_numbers = [fr.get("segment_number") for fr in frames if fr.get("segment_number") is not None]
-        max_seg_num = max(existing_seg_numbers) if existing_seg_numbers else 0
+        max_seg_num = max(
+            (fr["segment_number"] for fr in frames if fr.get("segment_number") is not None),
+            default=0
+        )
+
+        # Column arrays of the frames; merges select and group on these instead of the dicts
+        name_ids, key_codes = {}, {}
+        # The stack has room for every directive's merged rows (at most one per slice key,
+        # and merges add no new slice keys), so they are appended in place
+        arrays = frames_to_arrays(
+            frames, name_ids, key_codes, packed=is_packed, reserve_groups=len(merges_for_this_seg)
+        )
+        stack = arrays["pixel_data"].base
+        if is_packed:
+            # Point the frames at their rows of the mask stack so each mask is held in memory once
+            for i in np.flatnonzero(arrays["key_code"] >= 0):
+                frames[i]["pixel_data"] = arrays["pixel_data"][i]
 
         # Process each merge directive for this segmentation folder
         for merge_item in merges_for_this_seg:
@@ -179,54 +377,73 @@ def main():
                 print(f"[WARN] Invalid merge entry {merge_item} in {seg_folder_name}. Skipping.")
                 continue
 
-            # Summation: group frames by (ref_sop_uid, image_position_patient)
+            # Select the mergeable frames of the old objects and group them by slice key,
+            # groups ordered by their first matching frame
+            old_set = frozenset(old_objects)
+            wanted = [name_ids[name] for name in old_set if name in name_ids]
+            sel = np.flatnonzero(np.isin(arrays["name_id"], wanted) & (arrays["key_code"] >= 0))
+
+            # Masks are packed bitmaps, so a bitwise OR merges them. Lay each group out
+            # contiguously and reduce all groups with a single call; empty results are skipped.
             slice_map = {}
-            for fr in frames:
-                seg_name = fr.get("segment_name")
-                if seg_name not in old_objects:
-                    continue
-                px_data = fr.get("pixel_data")
-                ref_sop_uid = fr.get("ref_sop_uid")
-                ipp = fr.get("image_position_patient")
-                if px_data is None or ref_sop_uid is None:
-                    continue
-                key = (ref_sop_uid, tuple(ipp) if ipp else None)
-                if key not in slice_map:
-                    slice_map[key] = np.zeros(px_data.shape, dtype=px_data.dtype)
-                slice_map[key] += px_data
-
-            # Clip summed mask to binary (max 1)
-            for key in slice_map:
-                np.clip(slice_map[key], 0, 1, out=slice_map[key])
+            if sel.size:
+                codes, first, inverse = np.unique(
+                    arrays["key_code"][sel], return_index=True, return_inverse=True
+                )
+                order = np.argsort(first)
+                rank = np.empty(len(codes), dtype=np.int64)
+                rank[order] = np.arange(len(codes))
+                group_of = rank[inverse]
+                sel = sel[np.argsort(group_of, kind="stable")]
+                offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+                np.cumsum(np.bincount(group_of, minlength=len(codes)), out=offsets[1:])
+                merged, nonempty = or_reduce(arrays["pixel_data"][sel], offsets)
+                slice_keys = list(key_codes)
+                for g in np.flatnonzero(nonempty):
+                    slice_map[slice_keys[codes[order[g]]]] = (
+                        merged[g], arrays["pixel_shape"][sel[offsets[g]]]
+                    )
 
             # Assign a new segment_number
             max_seg_num += 1
             new_seg_num = max_seg_num
 
-            # Build new frames for the merged object
-            new_frames = []
+            # Build new frames for the merged object (all-zero groups were dropped above)
+            new_frames = [None] * len(slice_map)
             start_index = len(frames)
             i = 0
-            for (ref_sop_uid, ipp), sum_mask in slice_map.items():
-                if not np.any(sum_mask):
-                    continue
-                new_frame = {
+            for (ref_sop_uid, ipp), (sum_mask, mask_shape) in slice_map.items():
+                if not is_packed:
+                    # unpacked pickle: store the merged mask as a plain 0/1 uint8 array
+                    sum_mask = unpack_mask(sum_mask, mask_shape)
+                new_frames[i] = {
                     "frame_index": start_index + i,
                     "segment_number": new_seg_num,
                     "segment_name": new_object_name,
                     "segment_color": None,  # Optionally, allow user to specify a color
                     "image_position_patient": list(ipp) if ipp else None,
                     "ref_sop_uid": ref_sop_uid,
-                    "pixel_data": sum_mask
+                    "pixel_data": sum_mask,
+                    "pixel_shape": mask_shape
                 }
-                new_frames.append(new_frame)
                 i += 1
 
             if not new_frames:
                 print(f"[INFO] Merge for objects {old_objects} into '{new_object_name}' produced no frames. Skipping.")
                 continue
 
-            # Append new frames to existing ones
+            # Append new frames to existing ones (and to the arrays for later directives);
+            # their masks go into the reserved rows of the stack, which packed frames point at
+            new_arrays = frames_to_arrays(new_frames, name_ids, key_codes, packed=is_packed)
+            lo = arrays["pixel_data"].shape[0]
+            hi = lo + len(new_frames)
+            stack[lo:hi] = new_arrays.pop("pixel_data")
+            arrays["pixel_data"] = stack[:hi]
+            for col in new_arrays:
+                arrays[col] = np.concatenate([arrays[col], new_arrays[col]])
+            if is_packed:
+                for j, fr in enumerate(new_frames):
+                    fr["pixel_data"] = stack[lo + j]
             frames.extend(new_frames)
             seg_data["frames"] = frames
             seg_data["num_frames"] = len(frames)
@@ -239,14 +456,15 @@ def main():
 
             print(f"[INFO] Merged objects {old_objects} into '{new_object_name}' with new segment_number {new_seg_num}. Added {len(new_frames)} frames.")
 
-        # After processing all merges for this segmentation, overwrite the pickle
-        with open(pkl_file_path, "wb") as pf:
-            pickle.dump(seg_data, pf)
+        # After processing all merges for this segmentation, overwrite the pickle.
+        # Protocol 5 (PEP 574) serializes the ndarray buffers without an extra copy, and the
+        # mostly-zero masks compress well, so a fast gzip level cuts the bytes written.
+        with gzip.open(pkl_file_path, "wb", compresslevel=1) as pf:
+            pickle.dump(seg_data, pf, protocol=5)
         print(f"[INFO] Updated pickle for {seg_folder_name} at {pkl_file_path}")
 
     # Finally, overwrite the PreparedSegmentations_info.json with the updated data
-    with open(prepared_json_path, "w") as f:
-        json.dump(prepared_data, f, indent=4)
+    write_json(prepared_data, prepared_json_path)
     print(f"\n[DONE] Merge plan applied. Updated {prepared_json_path}")
 
 if __name__ == "__main__":
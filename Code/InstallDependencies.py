@@ -22,7 +22,9 @@ def install_packages():
         "nibabel",
         "openpyxl",  # for optional Excel handling in step 2.2
         "numpy",
-        "pandas"     # optional, can be helpful for data manipulation
+        "pandas",    # optional, can be helpful for data manipulation
+        "numba",     # optional, JIT kernels in ConcatMultiplObjects and the Step_2_4 NIfTI/NRRD scripts
+        "orjson"     # optional, faster JSON reading/writing in Steps 2.1-2.4 and ConcatMultiplObjects
     ]
     for pkg in packages:
         subprocess.check_call([sys.executable, "-m", "pip", "install", pkg])
@@ -13,9 +13,30 @@ Date: YYYY-MM-DD
 """
 
 import os
+import gzip
 import pickle
 import sys
 import pydicom
+import numpy as np
+
+def load_pickle(pkl_path):
+    """
+    Load a segmentation pickle. Handles both plain pickles and the gzip-compressed
+    pickles written by Step_2_3 and ConcatMultiplObjects (detected by the gzip magic bytes).
+    """
+    with open(pkl_path, "rb") as pf:
+        magic = pf.read(2)
+        pf.seek(0)
+        if magic == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=pf, mode="rb") as gz:
+                return pickle.load(gz)
+        return pickle.load(pf)
+
+def unpack_mask(packed, shape):
+    """
+    Rebuild a 0/1 uint8 mask of the given (rows, cols) shape from a np.packbits bitmap.
+    """
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape)
 
 def show_pickle_content(pickle_file_path):
     """
@@ -29,8 +50,13 @@ def show_pickle_content(pickle_file_path):
     if not os.path.exists(pickle_file_path):
         raise FileNotFoundError(f"Pickle file not found: {pickle_file_path}")
 
-    with open(pickle_file_path, "rb") as pkl_file:
-        content = pickle.load(pkl_file)
+    content = load_pickle(pickle_file_path)
+
+    # Merged pickles (ConcatMultiplObjects) store bit-packed masks; show them as 2D arrays
+    if content.get("pixel_encoding") == "packbits":
+        for fr in content.get("frames", []):
+            if fr.get("pixel_data") is not None:
+                fr["pixel_data"] = unpack_mask(fr["pixel_data"], fr["pixel_shape"])
 
     print("Pickle file content:")
     for key, value in content.items():
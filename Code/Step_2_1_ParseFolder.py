@@ -23,8 +23,137 @@ import json
 import random
 import pydicom
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then written with the stdlib json module
+
+# Worker threads used to probe series/assessor folders (I/O-bound, so more than the core count)
+PROBE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Only these header tags are read from each DICOM; pydicom skips everything else.
+SCAN_TAGS = [
+    (0x0020, 0x0011),  # SeriesNumber
+    (0x0020, 0x0003),
+    (0x0020, 0x000E),  # SeriesInstanceUID
+    (0x0008, 0x103E),  # SeriesDescription
+    (0x0008, 0x0016),  # SOPClassUID
+]
+SEG_TAGS = [
+    (0x0008, 0x103E),  # SeriesDescription
+    (0x0008, 0x1115),  # ReferencedSeriesSequence
+]
+
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+def list_files_with_ext(folder_path, ext):
+    """Return the names of the regular files in folder_path ending with ext (case-insensitive)."""
+    with os.scandir(folder_path) as it:
+        return [e.name for e in it if e.is_file() and e.name.lower().endswith(ext)]
+
+def list_subfolders(folder_path):
+    """
+    Return (name, path) of the subdirectories of folder_path. DirEntry.is_dir() is answered
+    from the directory listing itself, so no per-entry stat() is needed.
+    """
+    with os.scandir(folder_path) as it:
+        return [(e.name, e.path) for e in it if e.is_dir()]
 
-def parse_scans_info(study_path, output_dir, output_json="StudySeries_info.json"):
+def probe_series_folder(series_folder_name, series_folder_path, check_consistency=True):
+    """
+    Read the DICOM metadata of one SCANS subfolder (see parse_scans_info).
+
+    Returns
+    -------
+    (str, dict or None)
+        The folder name and its info dictionary, or None if the folder has no DICOM subfolder.
+    """
+    dicom_folder_path = os.path.join(series_folder_path, "DICOM")
+
+    if not os.path.isdir(dicom_folder_path):
+        return series_folder_name, None
+
+    # Attempt to read two random DICOM files (or the first two if not enough)
+    dcm_files = list_files_with_ext(dicom_folder_path, ".dcm")
+    if len(dcm_files) == 0:
+        # No DICOM files
+        return series_folder_name, {
+            "series_folder_path": dicom_folder_path,
+            "series_number": None,
+            "series_uid": None,
+            "series_description": None,
+            "class_uid": None,
+            "scan_errors": "No DICOM files found"
+        }
+
+    n_to_read = 2 if check_consistency else 1
+    if len(dcm_files) > n_to_read:
+        selected_files = random.sample(dcm_files, n_to_read)
+    else:
+        selected_files = dcm_files
+
+    info_list = []
+    error_message = None
+
+    for dcm_file in selected_files:
+        dcm_path = os.path.join(dicom_folder_path, dcm_file)
+        try:
+            ds = pydicom.dcmread(dcm_path, stop_before_pixels=True, force=True, specific_tags=SCAN_TAGS)
+            series_number = getattr(ds, "SeriesNumber", None)  # (0020,0011)
+            # Per instructions, check for (0020,0003) then fallback to (0020,000E).
+            series_uid = ds.get((0x0020, 0x0003), None)
+            if series_uid is None:
+                series_uid = getattr(ds, "SeriesInstanceUID", None)
+
+            series_description = getattr(ds, "SeriesDescription", None)  # (0008,103E)
+            class_uid = getattr(ds, "SOPClassUID", None)  # (0008,0016)
+
+            info_list.append({
+                "series_number": str(series_number) if series_number else None,
+                "series_uid": str(series_uid),
+                "series_description": str(series_description),
+                "class_uid": str(class_uid)
+            })
+        except Exception as e:
+            error_message = f"Error reading {dcm_path}: {e}"
+            info_list.append({
+                "series_number": None,
+                "series_uid": None,
+                "series_description": None,
+                "class_uid": None
+            })
+
+    # Check for inconsistency if we have 2 items
+    if len(info_list) == 2:
+        fields_to_compare = ["series_number", "series_uid", "series_description", "class_uid"]
+        mismatch = any(
+            info_list[0][fld] != info_list[1][fld] for fld in fields_to_compare
+        )
+        if mismatch:
+            error_message = f"Inconsistent metadata in {series_folder_name}"
+
+    chosen_info = info_list[0] if len(info_list) > 0 else {}
+
+    return series_folder_name, {
+        "series_folder_path": dicom_folder_path,
+        "series_number": chosen_info.get("series_number", None),
+        "series_uid": chosen_info.get("series_uid", None),
+        "series_description": chosen_info.get("series_description", None),
+        "class_uid": chosen_info.get("class_uid", None),
+        "scan_errors": error_message
+    }
+
+
+def parse_scans_info(study_path, output_dir, output_json="StudySeries_info.json", check_consistency=True):
     """
     Parse the SCANS folder to extract basic DICOM info for each series.
     Writes results to a JSON file in output_dir.
@@ -40,6 +169,9 @@ def parse_scans_info(study_path, output_dir, output_json="StudySeries_info.json"
     output_json : str, optional
         Filename (not path) for saving the SCANS metadata as JSON.
         Defaults to 'StudySeries_info.json'.
+    check_consistency : bool, optional
+        If True (default), read two random DICOM files per series and report an
+        error when their metadata differ. If False, read a single file per series.
 
     Returns
     -------
@@ -59,95 +191,121 @@ def parse_scans_info(study_path, output_dir, output_json="StudySeries_info.json"
     if not os.path.exists(scans_dir):
         raise FileNotFoundError(f"SCANS directory not found in {study_path}")
 
-    all_scans_info = {}
-    # List each subfolder in SCANS
-    for series_folder_name in os.listdir(scans_dir):
-        series_folder_path = os.path.join(scans_dir, series_folder_name)
-        dicom_folder_path = os.path.join(series_folder_path, "DICOM")
-
-        if not os.path.isdir(dicom_folder_path):
-            continue
-
-        # Attempt to read two random DICOM files (or the first two if not enough)
-        dcm_files = [f for f in os.listdir(dicom_folder_path) if f.lower().endswith(".dcm")]
-        if len(dcm_files) == 0:
-            # No DICOM files
-            all_scans_info[series_folder_name] = {
-                "series_folder_path": dicom_folder_path,
-                "series_number": None,
-                "series_uid": None,
-                "series_description": None,
-                "class_uid": None,
-                "scan_errors": "No DICOM files found"
-            }
-            continue
-
-        if len(dcm_files) > 2:
-            selected_files = random.sample(dcm_files, 2)
-        else:
-            selected_files = dcm_files
-
-        info_list = []
-        error_message = None
-
-        for dcm_file in selected_files:
-            dcm_path = os.path.join(dicom_folder_path, dcm_file)
-            try:
-                ds = pydicom.dcmread(dcm_path, stop_before_pixels=True, force=True)
-                series_number = getattr(ds, "SeriesNumber", None)  # (0020,0011)
-                # Per instructions, check for (0020,0003) then fallback to (0020,000E).
-                series_uid = ds.get((0x0020, 0x0003), None)
-                if series_uid is None:
-                    series_uid = getattr(ds, "SeriesInstanceUID", None)
-
-                series_description = getattr(ds, "SeriesDescription", None)  # (0008,103E)
-                class_uid = getattr(ds, "SOPClassUID", None)  # (0008,0016)
-
-                info_list.append({
-                    "series_number": str(series_number) if series_number else None,
-                    "series_uid": str(series_uid),
-                    "series_description": str(series_description),
-                    "class_uid": str(class_uid)
-                })
-            except Exception as e:
-                error_message = f"Error reading {dcm_path}: {e}"
-                info_list.append({
-                    "series_number": None,
-                    "series_uid": None,
-                    "series_description": None,
-                    "class_uid": None
-                })
-
-        # Check for inconsistency if we have 2 items
-        if len(info_list) == 2:
-            fields_to_compare = ["series_number", "series_uid", "series_description", "class_uid"]
-            mismatch = any(
-                info_list[0][fld] != info_list[1][fld] for fld in fields_to_compare
-            )
-            if mismatch:
-                error_message = f"Inconsistent metadata in {series_folder_name}"
-
-        chosen_info = info_list[0] if len(info_list) > 0 else {}
-
-        all_scans_info[series_folder_name] = {
-            "series_folder_path": dicom_folder_path,
-            "series_number": chosen_info.get("series_number", None),
-            "series_uid": chosen_info.get("series_uid", None),
-            "series_description": chosen_info.get("series_description", None),
-            "class_uid": chosen_info.get("class_uid", None),
-            "scan_errors": error_message
-        }
+    # Probe each subfolder in SCANS in parallel; the work is dominated by disk reads
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as ex:
+        results = ex.map(
+            lambda entry: probe_series_folder(*entry, check_consistency),
+            list_subfolders(scans_dir)
+        )
+        all_scans_info = {name: info for name, info in results if info is not None}
 
     # Save as JSON in output_dir
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     output_path = os.path.join(output_dir, output_json)
-    with open(output_path, "w") as f:
-        json.dump(all_scans_info, f, indent=4)
+    write_json(all_scans_info, output_path)
     return all_scans_info
 
 
+def probe_assessor_folder(assessor_folder_name, assessor_folder_path):
+    """
+    Read the XML catalog and segmentation DICOM of one ASSESSORS subfolder (see parse_assessors_info).
+
+    Returns
+    -------
+    (str, dict or None)
+        The folder name and its info dictionary, or None if the folder has no SEG subfolder.
+    """
+    seg_folder_path = os.path.join(assessor_folder_path, "SEG")
+
+    if not os.path.isdir(seg_folder_path):
+        return assessor_folder_name, None
+
+    # Expect exactly one .dcm for the segmentation
+    dcm_files = list_files_with_ext(seg_folder_path, ".dcm")
+    xml_files = list_files_with_ext(seg_folder_path, ".xml")
+    dcm_files_set = set(dcm_files)
+
+    segmentor_name = None
+    created_time = None
+    exported_name = None
+    ref_class_uid_set = set()
+    ref_series_uid = None
+    errors = None
+
+    # Parse XML for 'createdBy' & 'createdTime' in <cat:entry ...>
+    for xml_file in xml_files:
+        xml_path = os.path.join(seg_folder_path, xml_file)
+        try:
+            # Stream the catalog and stop at the first <entry> describing our .dcm,
+            # instead of building the whole tree
+            with open(xml_path, "rb") as xf:
+                for _, entry_elem in ET.iterparse(xf, events=("end",)):
+                    if entry_elem.tag.rsplit("}", 1)[-1] != "entry":
+                        continue
+                    possible_dcm_id = entry_elem.attrib.get("ID", "")
+                    if possible_dcm_id in dcm_files_set:
+                        segmentor_name = entry_elem.attrib.get("createdBy", None)
+                        created_time = entry_elem.attrib.get("createdTime", None)
+                        break
+                    entry_elem.clear()
+        except Exception as e:
+            if errors:
+                errors += f" | Error parsing XML {xml_path}: {str(e)}"
+            else:
+                errors = f"Error parsing XML {xml_path}: {str(e)}"
+
+    # Parse the DICOM for (0008,103E) description, ref_class_uid, ref_series_uid
+    for dcm_file in dcm_files:
+        dcm_path = os.path.join(seg_folder_path, dcm_file)
+        try:
+            ds = pydicom.dcmread(dcm_path, stop_before_pixels=True, force=True, specific_tags=SEG_TAGS)
+
+            # (0008,103E)
+            desc_elem = ds.get((0x0008, 0x103E))
+            if desc_elem is not None:
+                exported_name = desc_elem.value
+            else:
+                exported_name = "Unknown"
+
+            # Collect SOP Class UIDs from ReferencedSeriesSequence->ReferencedInstanceSequence
+            if hasattr(ds, "ReferencedSeriesSequence"):
+                for series_item in ds.ReferencedSeriesSequence:
+                    if hasattr(series_item, "ReferencedInstanceSequence"):
+                        for ref_inst_item in series_item.ReferencedInstanceSequence:
+                            sop_class_uid_elem = ref_inst_item.get((0x0008, 0x1150), None)
+                            if sop_class_uid_elem is not None:
+                                sop_class_uid_val = sop_class_uid_elem.value
+                                ref_class_uid_set.add(sop_class_uid_val)
+
+                    # Series Instance UID
+                    if hasattr(series_item, "SeriesInstanceUID"):
+                        ref_series_uid = series_item.SeriesInstanceUID
+
+        except Exception as e:
+            if errors:
+                errors += f" | Error parsing DICOM {dcm_path}: {str(e)}"
+            else:
+                errors = f"Error parsing DICOM {dcm_path}: {str(e)}"
+
+    # Convert the set of unique UIDs to a comma-separated string
+    if ref_class_uid_set:
+        ref_class_uid_str = ",".join(sorted(ref_class_uid_set))
+    else:
+        ref_class_uid_str = None
+
+    return assessor_folder_name, {
+        "assessor_folder_path": seg_folder_path,
+        "segmentor_name": segmentor_name,
+        "created_time": created_time,
+        "exported_name": str(exported_name) if exported_name else None,
+        "ref_class_uid": ref_class_uid_str,
+        "ref_series_uid": str(ref_series_uid) if ref_series_uid else None,
+        "errors": errors
+    }
+
+
 def parse_assessors_info(study_path, output_dir, output_json="Segmentations_info.json"):
     """
     Parse the ASSESSORS folder to extract XML-based segmentor info and DICOM-based segmentation info.
@@ -184,101 +342,20 @@ def parse_assessors_info(study_path, output_dir, output_json="Segmentations_info
     if not os.path.exists(assessors_dir):
         raise FileNotFoundError(f"ASSESSORS directory not found in {study_path}")
 
-    all_assessors_info = {}
-    for assessor_folder_name in os.listdir(assessors_dir):
-        assessor_folder_path = os.path.join(assessors_dir, assessor_folder_name)
-        seg_folder_path = os.path.join(assessor_folder_path, "SEG")
-
-        if not os.path.isdir(seg_folder_path):
-            continue
-
-        # Expect exactly one .dcm for the segmentation
-        dcm_files = [f for f in os.listdir(seg_folder_path) if f.lower().endswith(".dcm")]
-        xml_files = [f for f in os.listdir(seg_folder_path) if f.lower().endswith(".xml")]
-
-        segmentor_name = None
-        created_time = None
-        exported_name = None
-        ref_class_uid_set = set()
-        ref_series_uid = None
-        errors = None
-
-        # Parse XML for 'createdBy' & 'createdTime' in <cat:entry ...>
-        for xml_file in xml_files:
-            xml_path = os.path.join(seg_folder_path, xml_file)
-            try:
-                tree = ET.parse(xml_path)
-                root = tree.getroot()
-                entries = root.findall(".//{*}entry")
-                for entry_elem in entries:
-                    if entry_elem is not None:
-                        possible_dcm_id = entry_elem.attrib.get("ID", "")
-                        if possible_dcm_id in dcm_files:
-                            segmentor_name = entry_elem.attrib.get("createdBy", None)
-                            created_time = entry_elem.attrib.get("createdTime", None)
-                            break
-            except Exception as e:
-                if errors:
-                    errors += f" | Error parsing XML {xml_path}: {str(e)}"
-                else:
-                    errors = f"Error parsing XML {xml_path}: {str(e)}"
-
-        # Parse the DICOM for (0008,103E) description, ref_class_uid, ref_series_uid
-        for dcm_file in dcm_files:
-            dcm_path = os.path.join(seg_folder_path, dcm_file)
-            try:
-                ds = pydicom.dcmread(dcm_path, stop_before_pixels=True, force=True)
-
-                # (0008,103E)
-                desc_elem = ds.get((0x0008, 0x103E))
-                if desc_elem is not None:
-                    exported_name = desc_elem.value
-                else:
-                    exported_name = "Unknown"
-
-                # Collect SOP Class UIDs from ReferencedSeriesSequence->ReferencedInstanceSequence
-                if hasattr(ds, "ReferencedSeriesSequence"):
-                    for series_item in ds.ReferencedSeriesSequence:
-                        if hasattr(series_item, "ReferencedInstanceSequence"):
-                            for ref_inst_item in series_item.ReferencedInstanceSequence:
-                                sop_class_uid_elem = ref_inst_item.get((0x0008, 0x1150), None)
-                                if sop_class_uid_elem is not None:
-                                    sop_class_uid_val = sop_class_uid_elem.value
-                                    ref_class_uid_set.add(sop_class_uid_val)
-
-                        # Series Instance UID
-                        if hasattr(series_item, "SeriesInstanceUID"):
-                            ref_series_uid = series_item.SeriesInstanceUID
-
-            except Exception as e:
-                if errors:
-                    errors += f" | Error parsing DICOM {dcm_path}: {str(e)}"
-                else:
-                    errors = f"Error parsing DICOM {dcm_path}: {str(e)}"
-
-        # Convert the set of unique UIDs to a comma-separated string
-        if ref_class_uid_set:
-            ref_class_uid_str = ",".join(sorted(ref_class_uid_set))
-        else:
-            ref_class_uid_str = None
-
-        all_assessors_info[assessor_folder_name] = {
-            "assessor_folder_path": seg_folder_path,
-            "segmentor_name": segmentor_name,
-            "created_time": created_time,
-            "exported_name": str(exported_name) if exported_name else None,
-            "ref_class_uid": ref_class_uid_str,
-            "ref_series_uid": str(ref_series_uid) if ref_series_uid else None,
-            "errors": errors
-        }
+    # Probe each subfolder in ASSESSORS in parallel; the work is dominated by disk reads
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as ex:
+        results = ex.map(
+            lambda entry: probe_assessor_folder(*entry),
+            list_subfolders(assessors_dir)
+        )
+        all_assessors_info = {name: info for name, info in results if info is not None}
 
     # Save as JSON in output_dir
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     output_path = os.path.join(output_dir, output_json)
-    with open(output_path, "w") as f:
-        json.dump(all_assessors_info, f, indent=4)
+    write_json(all_assessors_info, output_path)
     return all_assessors_info
 
 
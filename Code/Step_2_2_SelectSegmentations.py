@@ -35,6 +35,7 @@ Date: 2025-02-05
 """
 
 import os
+import re
 import json
 
 try:
@@ -42,6 +43,24 @@ try:
 except ImportError:
     openpyxl = None  # in case user didn't install; Step_2_2 is optional.
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then read and written with the stdlib json module
+
+# "Segmentations" cell parsing: an optional [...] wrapper, then names separated by , or ;
+BRACKETS_RE = re.compile(r"^\s*\[(.*)\]\s*$", re.S)
+SEG_SPLIT_RE = re.compile(r"\s*[;,]\s*")
+
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
 def load_segmentations_info(seg_info_path):
     """
     Load the existing Segmentations_info.json file.
@@ -58,9 +77,86 @@ def load_segmentations_info(seg_info_path):
     """
     if not os.path.exists(seg_info_path):
         raise FileNotFoundError(f"Segmentations_info.json not found at: {seg_info_path}")
-    with open(seg_info_path, "r") as f:
-        data = json.load(f)
-    return data
+    with open(seg_info_path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def parse_segmentations_cell(row_segs):
+    """
+    Split the value of a "Segmentations" cell into the list of requested names.
+    The cell can hold comma/semicolon-separated names (optionally inside brackets),
+    'all', a single non-string value, or nothing.
+    """
+    if row_segs is None:
+        return []
+    if not isinstance(row_segs, str):
+        # might be a single value
+        return [str(row_segs)]
+    # Check if the string is a list-like format and remove the brackets
+    m = BRACKETS_RE.match(row_segs)
+    if m:
+        row_segs = m.group(1)
+    return SEG_SPLIT_RE.split(row_segs.strip())
+
+def get_selection_from_excel_bulk(excel_file, case_numbers):
+    """
+    Parse an Excel file (assuming columns "CaseNumber" and "Segmentations") once and
+    look up the requested segmentations of several cases. Use this instead of calling
+    get_selection_from_excel per case, which re-parses the workbook every time.
+
+    Parameters
+    ----------
+    excel_file : str
+        Path to an Excel file.
+    case_numbers : iterable of str or int
+        The study IDs or case numbers to match in the "CaseNumber" column.
+
+    Returns
+    -------
+    dict
+        case_number -> list of requested segmentation names (empty if the case has no row).
+        The first matching row of a case is used.
+    """
+    selections = {}
+    pending = {}  # str(case_number) -> the case numbers given for it
+    for case_number in case_numbers:
+        selections[case_number] = []
+        pending.setdefault(str(case_number), []).append(case_number)
+
+    # Read-only mode streams the sheet instead of building the whole workbook in memory
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+
+        # Find columns: "CaseNumber" and "Segmentations" in the header row
+        case_col = None
+        seg_col = None
+        for col_idx, val in enumerate(next(rows, ())):
+            if val is None:
+                continue
+            key = val.lower() if isinstance(val, str) else str(val).lower()
+            if key == "casenumber":
+                case_col = col_idx
+            elif key == "segmentations":
+                seg_col = col_idx
+        if case_col is None or seg_col is None:
+            # Without both columns no row can match; don't scan the rest of the sheet
+            return selections
+
+        for row in rows:
+            if not pending:
+                break
+            # read-only rows stop at their last non-empty cell, so they can be short
+            case_value = row[case_col] if case_col < len(row) else None
+            found = pending.pop(str(case_value), None)
+            if found is not None:
+                seg_value = row[seg_col] if seg_col < len(row) else None
+                for case_number in found:
+                    selections[case_number] = parse_segmentations_cell(seg_value)
+    finally:
+        wb.close()  # read-only workbooks keep the file open until closed
+
+    return selections
 
 def get_selection_from_excel(excel_file, case_number):
     """
@@ -79,41 +175,7 @@ def get_selection_from_excel(excel_file, case_number):
     list
         List of requested segmentation names. Could contain 'all' if user typed that in Excel.
     """
-    selections = []
-    wb = openpyxl.load_workbook(excel_file)
-    ws = wb.active
-
-    # Find columns: "CaseNumber" and "Segmentations"
-    case_col = None
-    seg_col = None
-
-    for idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
-        if idx == 1:
-            # header row
-            for col_idx, val in enumerate(row):
-                if str(val).lower() == "casenumber":
-                    case_col = col_idx
-                if str(val).lower() == "segmentations":
-                    seg_col = col_idx
-            continue
-
-        if case_col is not None and seg_col is not None:
-            row_case = row[case_col]
-            if str(row_case) == str(case_number):
-                row_segs = row[seg_col]
-                if row_segs is not None:
-                    if isinstance(row_segs, str):
-                        # Check if the string is a list-like format
-                        if row_segs.startswith("[") and row_segs.endswith("]"):
-                            row_segs = row_segs[1:-1]  # Remove the brackets
-                        splitted = [s.strip() for s in row_segs.replace(";", ",").split(",")]
-                        selections.extend(splitted)
-                    else:
-                    # might be a single value
-                        selections.append(str(row_segs))
-                break
-
-    return selections
+    return get_selection_from_excel_bulk(excel_file, [case_number])[case_number]
 
 def get_selection_manually(available_folders, available_exported_names):
     """
@@ -148,6 +210,27 @@ def get_selection_manually(available_folders, available_exported_names):
     else:
         return [s.strip() for s in segs_str.split(",") if s.strip()]
 
+def find_segmentation_key(requested_name, seg_info):
+    """
+    Case-insensitive lookup of one requested name in seg_info by scanning it directly.
+    A matching folder name takes precedence over a matching exported_name.
+
+    Returns
+    -------
+    str or None
+        The matching folder key, or None if nothing matched.
+    """
+    requested_cf = requested_name.casefold()
+    folder_hit = None
+    exported_hit = None
+    for folder_key, info_dict in seg_info.items():
+        if folder_key.casefold() == requested_cf:
+            folder_hit = folder_key
+        exported_name = info_dict.get("exported_name", "")
+        if exported_name and exported_name.casefold() == requested_cf:
+            exported_hit = folder_key
+    return folder_hit if folder_hit is not None else exported_hit
+
 def match_segmentations(user_requests, seg_info):
     """
     Match user-requested segmentation names to the available segmentations in seg_info.
@@ -185,35 +268,36 @@ def match_segmentations(user_requests, seg_info):
           The user strings that did not match any folder or exported_name.
     """
 
-    if "all" in [r.lower() for r in user_requests]:
+    if any(r.casefold() == "all" for r in user_requests):
         # If user asked for all, no need to search
         return seg_info.copy(), []
 
     matched = {}
     not_found = []
 
-    # Pre-build a map from folder-key to key, and exported_name to key
-    folder_map = {}
-    exported_map = {}
-    for folder_key, info_dict in seg_info.items():
-        # folder_key is e.g. "SEG_20241021_181708_943_S2"
-        folder_map[folder_key.lower()] = folder_key
-
-        exported_name = info_dict.get("exported_name", "")
-        if exported_name:
-            exported_map[exported_name.lower()] = folder_key
-
-    for requested_name in user_requests:
-        lower_req = requested_name.lower()
-        found_key = None
-
-        # Check folder map
-        if lower_req in folder_map:
-            found_key = folder_map[lower_req]
-        # Check exported map only if not found
-        elif lower_req in exported_map:
-            found_key = exported_map[lower_req]
-
+    # Exact folder names (e.g. pasted from the folder list) need no case-insensitive lookup
+    found_keys = [name if name in seg_info else None for name in user_requests]
+    pending = [i for i, key in enumerate(found_keys) if key is None]
+
+    if pending and len(pending) * 2 < len(seg_info):
+        # Few names left against a big catalog: compare in place instead of building a map
+        for i in pending:
+            found_keys[i] = find_segmentation_key(user_requests[i], seg_info)
+    elif pending:
+        # Build one case-insensitive map to the folder key. Exported names go in first so
+        # that folder names, which take precedence, overwrite them.
+        name_map = {}
+        for folder_key, info_dict in seg_info.items():
+            exported_name = info_dict.get("exported_name", "")
+            if exported_name:
+                name_map[exported_name.casefold()] = folder_key
+        for folder_key in seg_info:
+            # folder_key is e.g. "SEG_20241021_181708_943_S2"
+            name_map[folder_key.casefold()] = folder_key
+        for i in pending:
+            found_keys[i] = name_map.get(user_requests[i].casefold())
+
+    for requested_name, found_key in zip(user_requests, found_keys):
         if found_key is not None:
             matched[found_key] = seg_info[found_key]
         else:
@@ -249,8 +333,7 @@ def save_selected_segmentations(output_path, selected_dict, not_found_list):
         "selected_segmentations": selected_dict,
         "error_provided_name_not_valid_in_SEGs": not_found_list
     }
-    with open(output_path, "w") as fp:
-        json.dump(final_obj, fp, indent=4)
+    write_json(final_obj, output_path)
 
 def main():
     """
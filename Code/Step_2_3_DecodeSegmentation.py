@@ -6,7 +6,7 @@ Reads a JSON file containing selected segmentations (e.g. "SelectedSegmentations
 iterates over each segmentation, locates the single .dcm inside its assessor folder, and
 decodes the multi-frame DICOM to produce:
 
-    1) A .pkl file (including 2D pixel_data for each frame).
+    1) A gzip-compressed .pkl file (including 2D pixel_data for each frame).
     2) A .json file with the same metadata but without image data (smaller file size).
 
 After generating those artifacts, we add the following fields to each segmentation in
@@ -25,17 +25,98 @@ Date: 2025-02-06
 
 import os
 import sys
+import gzip
 import json
 import pickle
 import pydicom
 import numpy as np
-from collections import Counter
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then written with the stdlib json module
+
+# Worker processes used to decode segmentations (decoding and pickling are CPU-bound)
+DECODE_WORKERS = os.cpu_count() or 1
+
+# Buffer size for the output files: pickle and json.dump issue many small writes, which
+# are slow on network-mounted output folders
+WRITE_BUFFER_SIZE = 1 << 20
+
+def orjson_default(obj):
+    """
+    orjson only encodes exact floats; pydicom's DSfloat values (e.g. SliceThickness) are
+    float subclasses, so hand them over as plain floats.
+    """
+    if isinstance(obj, float):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(
+                obj, default=orjson_default,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+            ))
+    else:
+        with open(path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+            json.dump(obj, f, indent=2)
+
+def write_json_atomic(obj, path):
+    """
+    write_json to a temporary file, then move it over path, so that an interrupted
+    write never leaves a truncated JSON behind.
+    """
+    tmp_path = path + ".tmp"
+    write_json(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load the per-segmentation results recorded by an interrupted run (see main).
+
+    Returns
+    -------
+    dict
+        folder_name -> fields added to its entry (pkl_file, json_file, ...);
+        empty if there is no usable checkpoint.
+    """
+    if not os.path.exists(checkpoint_path):
+        return {}
+    try:
+        with open(checkpoint_path, "r") as f:
+            return json.load(f).get("done", {})
+    except (OSError, ValueError, AttributeError):
+        print(f"[WARN] Ignoring unreadable checkpoint {checkpoint_path}")
+        return {}
+
+def checkpoint_entry_is_complete(extras, load_pixels):
+    """
+    True if a checkpoint entry can be reused: its JSON output (and, unless only metadata
+    is refreshed, its pickle) is still on disk.
+    """
+    if not extras:
+        return False
+    json_file = extras.get("json_file")
+    pkl_file = extras.get("pkl_file")
+    if not json_file or not os.path.exists(json_file):
+        return False
+    return not load_pixels or bool(pkl_file and os.path.exists(pkl_file))
 
 def sanitize_for_json(obj):
     """
     Recursively convert any pydicom DataElement or other non-serializable objects
     into plain Python data structures (strings, lists, dicts, etc.).
     """
+    # Common case: one dict lookup on the exact type instead of a chain of isinstance checks
+    handler = JSON_SANITIZERS.get(type(obj))
+    if handler is not None:
+        return handler(obj)
+    # Subclasses (e.g. pydicom's DSfloat, IS and UID values) and everything else
     if isinstance(obj, (str, int, float, bool)) or obj is None:
         return obj
     if isinstance(obj, pydicom.dataelem.DataElement):
@@ -48,8 +129,28 @@ def sanitize_for_json(obj):
         return obj.tolist()
     return str(obj)
 
+def _sanitize_sequence(obj):
+    return [sanitize_for_json(x) for x in obj]
+
+def _sanitize_dict(obj):
+    return {k: sanitize_for_json(v) for k, v in obj.items()}
+
+# Exact type -> converter used by sanitize_for_json
+JSON_SANITIZERS = {
+    str: lambda obj: obj,
+    int: lambda obj: obj,
+    float: lambda obj: obj,
+    bool: lambda obj: obj,
+    type(None): lambda obj: obj,
+    list: _sanitize_sequence,
+    tuple: _sanitize_sequence,
+    dict: _sanitize_dict,
+    np.ndarray: lambda obj: obj.tolist(),
+    pydicom.dataelem.DataElement: lambda obj: str(obj.value),
+}
 
-def decode_segmentation_dcm(seg_dcm_path):
+
+def decode_segmentation_dcm(seg_dcm_path, load_pixels=True):
     """
     Decode a single segmentation .dcm file (multi-frame SEG),
     returning a dictionary with fields:
@@ -66,11 +167,21 @@ def decode_segmentation_dcm(seg_dcm_path):
         "num_frames"
         "frames": [ {frame_index, segment_number, segment_name, segment_color,
                      image_position_patient, ref_sop_uid, pixel_data}, ... ]
+
+    For BINARY segmentations, each frame's pixel_data is np.packbits-packed (1 bit per
+    pixel) with its (rows, cols) in "pixel_shape", and the dictionary has
+    "pixel_encoding": "packbits", the same format ConcatMultiplObjects writes.
+
+    A frame listed in the functional groups but absent from the pixel data gets
+    pixel_data None and "missing": True.
+
+    With load_pixels=False the Pixel Data element is not read or decoded at all and every
+    frame's pixel_data is None (metadata only).
     """
     if not os.path.exists(seg_dcm_path):
         raise FileNotFoundError(f"Seg DICOM not found: {seg_dcm_path}")
 
-    ds = pydicom.dcmread(seg_dcm_path, force=True)
+    ds = pydicom.dcmread(seg_dcm_path, force=True, stop_before_pixels=not load_pixels)
 
     # Basic info
     segmentation_name = getattr(ds, "SeriesDescription", "Unnamed_Segmentation")  # (0008,103E)
@@ -135,17 +246,27 @@ def decode_segmentation_dcm(seg_dcm_path):
 
     # Build frames array
     frames = []
-    pixel_array_3d = ds.pixel_array  # shape => (num_frames, rows, cols)
     num_frames = getattr(ds, "NumberOfFrames", 0)
-
-    if hasattr(ds, "PerFrameFunctionalGroupsSequence") and len(ds.PerFrameFunctionalGroupsSequence) == num_frames:
-        for frame_index in range(num_frames):
-            frame = ds.PerFrameFunctionalGroupsSequence[frame_index]
+    pixel_array_3d = None
+    is_packed = False
+    if load_pixels:
+        # One contiguous array; every frame's pixel_data is a view into it
+        pixel_array_3d = np.ascontiguousarray(ds.pixel_array)  # shape => (num_frames, rows, cols)
+
+        # BINARY masks only hold 0/1: store each frame as a bitmap (8 pixels per byte), all
+        # frames packed in one call. frame_shape keeps the (rows, cols) needed to unpack.
+        is_packed = segmentation_type.upper() == "BINARY"
+        frame_shape = tuple(pixel_array_3d.shape[1:])
+        if is_packed:
+            pixel_array_3d = np.packbits(pixel_array_3d.reshape(pixel_array_3d.shape[0], -1), axis=1)
+
+    # Hoist the sequence once; per frame, Dataset.get() replaces the hasattr/getattr/len checks
+    per_frame_groups = ds.get("PerFrameFunctionalGroupsSequence")
+    if per_frame_groups is not None and len(per_frame_groups) == num_frames:
+        for frame_index, frame in enumerate(per_frame_groups):
             # SegmentIdentificationSequence
-            segment_number = None
-            if hasattr(frame, "SegmentIdentificationSequence") and len(frame.SegmentIdentificationSequence) > 0:
-                seg_id_seq_item = frame.SegmentIdentificationSequence[0]
-                segment_number = getattr(seg_id_seq_item, "ReferencedSegmentNumber", None)
+            seq = frame.get("SegmentIdentificationSequence")
+            segment_number = seq[0].get("ReferencedSegmentNumber") if seq else None
 
             # seg_name, seg_color from segment_map
             seg_name = None
@@ -155,22 +276,22 @@ def decode_segmentation_dcm(seg_dcm_path):
                 seg_color = segment_map[segment_number]["color"]
 
             # ref_sop_uid -> DerivationImageSequence => SourceImageSequence => ReferencedSOPInstanceUID
-            ref_sop_uid_this_frame = None
-            if hasattr(frame, "DerivationImageSequence") and len(frame.DerivationImageSequence) > 0:
-                deriv_item = frame.DerivationImageSequence[0]
-                if hasattr(deriv_item, "SourceImageSequence") and len(deriv_item.SourceImageSequence) > 0:
-                    ref_sop_uid_this_frame = getattr(deriv_item.SourceImageSequence[0], "ReferencedSOPInstanceUID", None)
+            seq = frame.get("DerivationImageSequence")
+            source_seq = seq[0].get("SourceImageSequence") if seq else None
+            ref_sop_uid_this_frame = source_seq[0].get("ReferencedSOPInstanceUID") if source_seq else None
 
             # image_position_patient -> PlanePositionSequence
-            image_position_patient = None
-            if hasattr(frame, "PlanePositionSequence") and len(frame.PlanePositionSequence) > 0:
-                image_position_patient = getattr(frame.PlanePositionSequence[0], "ImagePositionPatient", None)
-
-            # pixel_data
-            if frame_index < pixel_array_3d.shape[0]:
-                frame_pixel_data = pixel_array_3d[frame_index, :, :]
-            else:
-                frame_pixel_data = np.zeros((rows, columns), dtype=pixel_array_3d.dtype)
+            seq = frame.get("PlanePositionSequence")
+            image_position_patient = seq[0].get("ImagePositionPatient") if seq else None
+
+            # pixel_data (None if the pixel data has fewer frames than the functional groups)
+            frame_pixel_data = None
+            missing = False
+            if pixel_array_3d is not None:
+                if frame_index < pixel_array_3d.shape[0]:
+                    frame_pixel_data = pixel_array_3d[frame_index]
+                else:
+                    missing = True
 
             frame_dict = {
                 "frame_index": frame_index,
@@ -181,10 +302,15 @@ def decode_segmentation_dcm(seg_dcm_path):
                 "ref_sop_uid": ref_sop_uid_this_frame,
                 "pixel_data": frame_pixel_data
             }
+            if is_packed:
+                frame_dict["pixel_shape"] = frame_shape
+            if missing:
+                frame_dict["missing"] = True
             frames.append(frame_dict)
     else:
         # fallback if mismatch
-        num_frames = pixel_array_3d.shape[0]
+        if pixel_array_3d is not None:
+            num_frames = pixel_array_3d.shape[0]
         for frame_index in range(num_frames):
             frame_dict = {
                 "frame_index": frame_index,
@@ -193,8 +319,10 @@ def decode_segmentation_dcm(seg_dcm_path):
                 "segment_color": None,
                 "image_position_patient": None,
                 "ref_sop_uid": None,
-                "pixel_data": pixel_array_3d[frame_index, :, :]
+                "pixel_data": pixel_array_3d[frame_index] if pixel_array_3d is not None else None
             }
+            if is_packed:
+                frame_dict["pixel_shape"] = frame_shape
             frames.append(frame_dict)
 
     final_dict = {
@@ -211,14 +339,117 @@ def decode_segmentation_dcm(seg_dcm_path):
         "num_frames": len(frames),
         "frames": frames
     }
+    if is_packed:
+        final_dict["pixel_encoding"] = "packbits"
 
     return final_dict
 
 
+def process_segmentation(folder_name, seg_meta, out_dir, load_pixels=True):
+    """
+    Decode one selected segmentation and write its .pkl and _withoutImageData.json
+    files into out_dir (see main). Runs in a worker process, so it returns the fields
+    to add to the segmentation's entry instead of modifying seg_meta.
+
+    With load_pixels=False only the metadata is read: the pixel data is not decoded,
+    the .pkl is not written, and pkl_file points to an existing .pkl (or is None).
+
+    Returns
+    -------
+    dict or None
+        pkl_file, json_file, num_frames, segment_name_count and ref_series_uid,
+        or None if the segmentation was skipped.
+    """
+    assessor_path = seg_meta.get("assessor_folder_path", "")
+    if not os.path.isdir(assessor_path):
+        print(f"Skipping {folder_name} - invalid assessor_folder_path: {assessor_path}")
+        return None
+
+    # Typically one .dcm in that folder; stop listing at the first one
+    with os.scandir(assessor_path) as it:
+        seg_dcm_path = next(
+            (e.path for e in it if e.is_file() and e.name.lower().endswith(".dcm")), None
+        )
+    if seg_dcm_path is None:
+        print(f"Skipping {folder_name} - no .dcm files found in {assessor_path}")
+        return None
+
+    # Decode
+    decoded_dict = decode_segmentation_dcm(seg_dcm_path, load_pixels=load_pixels)
+
+    # Build output filename
+    exported_name = seg_meta.get("exported_name", "UnknownExportName").replace(" ", "_")
+    segmentor_name = seg_meta.get("segmentor_name", "UnknownSegmentor").replace(" ", "_")
+    safe_folder = folder_name.replace(" ", "_")
+    out_filename_base = f"EN_{exported_name}_SN_{segmentor_name}_FN_{safe_folder}"
+
+    # 1) Save pickle with full image data
+    pkl_path = os.path.join(out_dir, f"{out_filename_base}.pkl")
+    if load_pixels:
+        # Protocol 5 (PEP 574) writes the ndarray buffers directly instead of copying them.
+        # The masks are mostly zeros, so a fast gzip level shrinks the file many times over;
+        # every reader detects the gzip stream by its magic bytes.
+        with open(pkl_path, "wb", buffering=WRITE_BUFFER_SIZE) as raw, \
+                gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1) as pklf:
+            pickle.dump(decoded_dict, pklf, protocol=5)
+    elif not os.path.exists(pkl_path):
+        pkl_path = None
+
+    # 2) Create a JSON without pixel_data, then sanitize
+    dict_no_image = {}
+    for k, v in decoded_dict.items():
+        if k == "pixel_encoding":
+            continue  # describes pixel_data only
+        if k != "frames":
+            dict_no_image[k] = v
+        else:
+            frames_no_img = []
+            for fr in v:
+                fr_copy = dict(fr)
+                fr_copy.pop("pixel_data", None)  # remove heavy numpy data
+                fr_copy.pop("pixel_shape", None)
+                frames_no_img.append(fr_copy)
+            dict_no_image["frames"] = frames_no_img
+
+    dict_json_safe = sanitize_for_json(dict_no_image)
+    json_path = os.path.join(out_dir, f"{out_filename_base}_withoutImageData.json")
+    write_json(dict_json_safe, json_path)
+
+    # One print call, so the lines of parallel workers don't interleave
+    print(
+        f"[INFO] Decoded {folder_name} =>\n"
+        f"       PKL:  {os.path.basename(pkl_path) if pkl_path else '(not written)'}\n"
+        f"       JSON: {os.path.basename(json_path)}"
+    )
+
+    # -- Prepare extra metadata for final JSON update -- #
+    # segment_name_count => distinct non-None "segment_name" in frames
+    name_counter = {}
+    for fr in decoded_dict.get("frames", []):
+        name = fr["segment_name"]
+        if name is not None:
+            name_counter[name] = name_counter.get(name, 0) + 1
+    return {
+        "pkl_file": pkl_path,
+        "json_file": json_path,
+        "num_frames": decoded_dict.get("num_frames", 0),
+        "segment_name_count": name_counter,
+        # override with the one from the DICOM
+        "ref_series_uid": decoded_dict.get("ref_series_uid", None),
+    }
+
+
 def main():
     """
     Main script usage:
-      python Step_2_3_DecodeSegmentation.py <selected_segmentations_json>
+      python Step_2_3_DecodeSegmentation.py <selected_segmentations_json> [--metadata-only]
+
+    --metadata-only refreshes the JSON outputs without decoding any pixel data; existing
+    .pkl files are left as they are.
+
+    Progress is checkpointed to PreparedSegmentations_info.partial.json after every
+    segmentation. If a run is interrupted, the next run skips the segmentations recorded
+    there; the checkpoint is removed once PreparedSegmentations_info.json is written.
 
     Or if no arguments, it will prompt the user. The script will:
       - Load the specified "SelectedSegmentations_info.json".
@@ -242,6 +473,7 @@ def main():
         input_json = input("Enter path to SelectedSegmentations_info.json: ").strip()
     else:
         input_json = sys.argv[1]
+    load_pixels = "--metadata-only" not in sys.argv[2:]
 
     if not os.path.exists(input_json):
         print(f"ERROR: JSON file not found: {input_json}")
@@ -262,77 +494,53 @@ def main():
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    # Process each selected segmentation
-    for folder_name, seg_meta in selected_segmentations.items():
-        assessor_path = seg_meta.get("assessor_folder_path", "")
-        if not os.path.isdir(assessor_path):
-            print(f"Skipping {folder_name} - invalid assessor_folder_path: {assessor_path}")
-            continue
-
-        # Typically one .dcm in that folder
-        dcm_files = [f for f in os.listdir(assessor_path) if f.lower().endswith(".dcm")]
-        if len(dcm_files) == 0:
-            print(f"Skipping {folder_name} - no .dcm files found in {assessor_path}")
-            continue
-
-        seg_dcm_path = os.path.join(assessor_path, dcm_files[0])
-
-        # Decode
-        decoded_dict = decode_segmentation_dcm(seg_dcm_path)
-
-        # Build output filename
-        exported_name = seg_meta.get("exported_name", "UnknownExportName").replace(" ", "_")
-        segmentor_name = seg_meta.get("segmentor_name", "UnknownSegmentor").replace(" ", "_")
-        safe_folder = folder_name.replace(" ", "_")
-        out_filename_base = f"EN_{exported_name}_SN_{segmentor_name}_FN_{safe_folder}"
-
-        # 1) Save pickle with full image data
-        pkl_path = os.path.join(out_dir, f"{out_filename_base}.pkl")
-        with open(pkl_path, "wb") as pklf:
-            pickle.dump(decoded_dict, pklf)
-
-        # 2) Create a JSON without pixel_data, then sanitize
-        dict_no_image = {}
-        for k, v in decoded_dict.items():
-            if k != "frames":
-                dict_no_image[k] = v
-            else:
-                frames_no_img = []
-                for fr in v:
-                    fr_copy = dict(fr)
-                    fr_copy.pop("pixel_data", None)  # remove heavy numpy data
-                    frames_no_img.append(fr_copy)
-                dict_no_image["frames"] = frames_no_img
-
-        dict_json_safe = sanitize_for_json(dict_no_image)
-        json_path = os.path.join(out_dir, f"{out_filename_base}_withoutImageData.json")
-        with open(json_path, "w") as jf:
-            json.dump(dict_json_safe, jf, indent=4)
-
-        print(f"[INFO] Decoded {folder_name} =>")
-        print(f"       PKL:  {os.path.basename(pkl_path)}")
-        print(f"       JSON: {os.path.basename(json_path)}")
-
-        # -- Prepare extra metadata for final JSON update -- #
-        # 1) path to pkl file
-        seg_meta["pkl_file"] = pkl_path
-        # 2) path to json file
-        seg_meta["json_file"] = json_path
-        # 3) num_frames
-        seg_meta["num_frames"] = decoded_dict.get("num_frames", 0)
-        # 4) segment_name_count => distinct non-None "segment_name" in frames
-        frames_list = decoded_dict.get("frames", [])
-        name_counter = Counter(
-            fr.get("segment_name") for fr in frames_list if fr.get("segment_name") is not None
-        )
-        seg_meta["segment_name_count"] = dict(name_counter)
-        # 5) ref_series_uid => override with the one from the DICOM
-        seg_meta["ref_series_uid"] = decoded_dict.get("ref_series_uid", None)
+    # Resume from the checkpoint of an interrupted run: segmentations recorded there whose
+    # output files still exist are not decoded again.
+    checkpoint_path = os.path.join(base_dir, "PreparedSegmentations_info.partial.json")
+    done = load_checkpoint(checkpoint_path)
+    items = list(selected_segmentations.items())
+    todo = []
+    for folder_name, seg_meta in items:
+        if checkpoint_entry_is_complete(done.get(folder_name), load_pixels):
+            print(f"[INFO] {folder_name} already decoded (checkpoint), skipping.")
+        else:
+            done.pop(folder_name, None)
+            todo.append((folder_name, seg_meta))
+
+    def record(folder_name, extras):
+        # Checkpoint after every segmentation, so a crash loses at most the one in progress
+        if extras is not None:
+            done[folder_name] = extras
+            write_json_atomic({"done": done}, checkpoint_path)
+
+    # Process each selected segmentation. They are independent, so several are decoded
+    # in parallel worker processes; the results are merged into `data` here.
+    workers = min(DECODE_WORKERS, len(todo))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = ex.map(
+                process_segmentation,
+                [folder_name for folder_name, _ in todo],
+                [seg_meta for _, seg_meta in todo],
+                repeat(out_dir),
+                repeat(load_pixels)
+            )
+            for (folder_name, _), extras in zip(todo, results):
+                record(folder_name, extras)
+    else:
+        for folder_name, seg_meta in todo:
+            record(folder_name, process_segmentation(folder_name, seg_meta, out_dir, load_pixels))
+
+    for folder_name, seg_meta in items:
+        extras = done.get(folder_name)
+        if extras is not None:
+            seg_meta.update(extras)
 
     # Save the updated dictionary to a new JSON named "PreparedSegmentations_info.json"
     out_prepared_json_path = os.path.join(base_dir, "PreparedSegmentations_info.json")
-    with open(out_prepared_json_path, "w") as f:
-        json.dump(data, f, indent=4)
+    write_json_atomic(data, out_prepared_json_path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
     print(f"[INFO] Prepared segmentations JSON saved to: {out_prepared_json_path}")
 
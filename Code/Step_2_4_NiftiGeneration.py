@@ -17,17 +17,201 @@ Implements three subtasks:
             - We build a 3D mask array for each unique segment_name and save it as
               "{series_number}_ON_{segment_name}__FN_{seg_folder_name}.nii".
 
+    main() runs 2.4.2 and 2.4.3 together, series by series (step_2_4_combined).
+
+    Every NIfTI written gets a "<name>.manifest.json" (shape, dtype, SOP UID hash) that
+    later runs use to skip outputs that are already up to date.
+
 Author: YourName
 Date: YYYY-MM-DD
 """
 
 import os
 import sys
+import gzip
 import json
+import hashlib
+import shutil
+import subprocess
 import pickle
+import multiprocessing
 import pydicom
 import numpy as np
 import nibabel as nib
+from dataclasses import dataclass, field
+from itertools import repeat
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then read and written with the stdlib json module
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None  # optional; masks are then placed slice by slice with NumPy
+
+# Worker threads used to read the files of a DICOM series (latency-bound I/O)
+READ_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+
+# Worker processes used to build segmentation NIfTIs in 2.4.3 (unpickling and mask
+# placement are CPU-bound)
+SEG_WORKERS = os.cpu_count() or 1
+
+def read_json(path):
+    """Load a JSON file, with orjson if installed, else the json module."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+def load_pickle(pkl_path):
+    """
+    Load a segmentation pickle. Handles both plain pickles and the gzip-compressed
+    pickles written by Step_2_3 and ConcatMultiplObjects (detected by the gzip magic bytes).
+    """
+    with open(pkl_path, "rb") as pf:
+        magic = pf.read(2)
+        pf.seek(0)
+        if magic == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=pf, mode="rb") as gz:
+                return pickle.load(gz)
+        return pickle.load(pf)
+
+@dataclass
+class SeriesGeometry:
+    """Slice order and geometry of a DICOM series: what 2.4.3 needs to place mask frames."""
+    sop_uid_list: list  # SOPInstanceUID of each slice, in volume order
+    shape: tuple        # (rows, cols, slices)
+    affine: np.ndarray
+    dtype: np.dtype     # dtype of the slices' pixel_array
+    # (sorted SOP UIDs, their slice indices) for np.searchsorted lookups; built once per
+    # series by sop_uid_lookup()
+    sop_lookup: tuple = field(default=None, repr=False, compare=False)
+
+def sop_uid_lookup(geometry):
+    """
+    The (sorted_uids, slice_indices) arrays used to map SOP UIDs to slices, built on
+    first use and kept on the SeriesGeometry, so all segmentations of a series share it.
+    When a UID appears on several slices, the last slice is used.
+    """
+    if geometry.sop_lookup is None:
+        sop_arr = np.array([str(u) for u in geometry.sop_uid_list])
+        order = np.argsort(sop_arr, kind="stable")
+        geometry.sop_lookup = (sop_arr[order], order.astype(np.int64))
+    return geometry.sop_lookup
+
+# abspath(series_folder_path) -> SeriesGeometry of every series read in this process, so
+# 2.4.3 does not read the DICOMs that 2.4.2 already read again
+SERIES_GEOMETRY_CACHE = {}
+
+# abspath(series_folder_path) -> its .dcm files (None if the folder is missing), listed
+# once per process and shared by 2.4.2 and 2.4.3
+DCM_FILES_CACHE = {}
+
+def save_series_geometry(geometry, series_folder_path, sidecar_path):
+    """
+    Write a SeriesGeometry next to the series' .nii (as <series_number>.sopuids.json),
+    so 2.4.3 can run in a separate process without re-reading the DICOM series.
+    """
+    write_json({
+        "series_folder_path": os.path.abspath(series_folder_path),
+        "sop_uid_list": geometry.sop_uid_list,
+        "shape": list(geometry.shape),
+        "affine": geometry.affine.tolist(),
+        "dtype": np.dtype(geometry.dtype).str
+    }, sidecar_path)
+
+def list_dcm_files(series_folder_path):
+    """Sorted paths of the .dcm files in a series folder (one os.scandir, no stat calls)."""
+    with os.scandir(series_folder_path) as it:
+        return sorted(e.path for e in it if e.name.endswith(".dcm") and not e.name.startswith("."))
+
+def series_dcm_files(series_info):
+    """
+    The .dcm files of a Ready2Nifti series_info, listed on first use and then taken from
+    DCM_FILES_CACHE. None if the series folder is missing.
+    """
+    series_path = series_info.get("series_folder_path")
+    if not series_path:
+        return None
+    key = os.path.abspath(series_path)
+    if key not in DCM_FILES_CACHE:
+        try:
+            DCM_FILES_CACHE[key] = list_dcm_files(series_path)
+        except OSError:
+            DCM_FILES_CACHE[key] = None
+    return DCM_FILES_CACHE[key]
+
+def load_series_geometry(series_folder_path, sidecar_path=None, dcm_files=None):
+    """
+    SeriesGeometry of a series: from the in-process cache, else from the sidecar written
+    by 2.4.2 (if it belongs to this series folder), else by reading the DICOM headers
+    (of dcm_files if given, else of the .dcm files in series_folder_path).
+    """
+    key = os.path.abspath(series_folder_path)
+    geometry = SERIES_GEOMETRY_CACHE.get(key)
+    if geometry is None and sidecar_path and os.path.exists(sidecar_path):
+        try:
+            saved = read_json(sidecar_path)
+            if saved["series_folder_path"] == key:
+                geometry = SeriesGeometry(
+                    sop_uid_list=saved["sop_uid_list"],
+                    shape=tuple(saved["shape"]),
+                    affine=np.array(saved["affine"], dtype=float),
+                    dtype=np.dtype(saved["dtype"])
+                )
+        except (OSError, ValueError, KeyError, TypeError):
+            geometry = None  # unreadable sidecar; fall back to the DICOMs
+    if geometry is None:
+        geometry = load_sop_uid_order(series_folder_path, dcm_files)
+    SERIES_GEOMETRY_CACHE[key] = geometry
+    return geometry
+
+def sop_uid_hash(sop_uid_list):
+    """md5 of the slice SOPInstanceUIDs in volume order (identifies the slice layout)."""
+    return hashlib.md5(",".join(str(u) for u in sop_uid_list).encode()).hexdigest()
+
+def manifest_path_for(nii_path):
+    """Path of the manifest of a NIfTI: "<name>.nii[.gz]" -> "<name>.manifest.json"."""
+    stem = nii_path[:-3] if nii_path.endswith(".gz") else nii_path
+    return os.path.splitext(stem)[0] + ".manifest.json"
+
+def write_manifest(nii_path, shape, dtype, sop_uid_list):
+    """
+    Write <name>.manifest.json describing a created NIfTI (shape, dtype and the
+    SOP UID hash of its series), atomically, so later runs can skip it without opening it.
+    """
+    manifest_path = manifest_path_for(nii_path)
+    tmp_path = manifest_path + ".tmp"
+    write_json({
+        "shape": [int(x) for x in shape],
+        "dtype": np.dtype(dtype).str,
+        "sop_hash": sop_uid_hash(sop_uid_list)
+    }, tmp_path)
+    os.replace(tmp_path, manifest_path)
+
+def read_manifest(nii_path):
+    """The manifest of nii_path as a dict, or None if the NIfTI or its manifest is missing/unreadable."""
+    manifest_path = manifest_path_for(nii_path)
+    if not os.path.exists(nii_path) or not os.path.exists(manifest_path):
+        return None
+    try:
+        manifest = read_json(manifest_path)
+        manifest["shape"] = tuple(manifest["shape"])
+        return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
 
 # ----------------------------------------------------------------
 # 2.4.1 - MATCH REF_SERIES_UID AND CREATE Ready2Nifti_info.json
@@ -54,14 +238,20 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
         The path to the newly created Ready2Nifti_info.json
     """
     # Load prepared info
-    with open(prepared_json_path, "r") as f:
-        prepared_data = json.load(f)
+    prepared_data = read_json(prepared_json_path)
 
     # Load study series info
-    with open(study_series_json_path, "r") as f:
-        study_series_data = json.load(f)
+    study_series_data = read_json(study_series_json_path)
 
     seg_dict = prepared_data.get("selected_segmentations", {})
+
+    # Index the SCANS entries by series_uid once (the first entry wins for duplicate UIDs)
+    series_by_uid = {}
+    for series_key, series_info in study_series_data.items():
+        series_uid = series_info.get("series_uid")
+        if series_uid:
+            series_by_uid.setdefault(series_uid, series_info)
+
     # For each segmentation, find series by matching ref_series_uid
     for seg_folder_name, seg_info in seg_dict.items():
         ref_uid = seg_info.get("ref_series_uid", None)
@@ -69,13 +259,7 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
             continue
 
         # Find matching SCANS entry
-        matched_series_key = None
-        matched_series_info = None
-        for series_key, series_info in study_series_data.items():
-            if series_info.get("series_uid") == ref_uid:
-                matched_series_key = series_key
-                matched_series_info = series_info
-                break
+        matched_series_info = series_by_uid.get(ref_uid)
 
         if matched_series_info:
             seg_info["series_info"] = {
@@ -90,8 +274,7 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
     # Write out
     out_dir = os.path.dirname(os.path.abspath(prepared_json_path))
     out_path = os.path.join(out_dir, output_json)
-    with open(out_path, "w") as f:
-        json.dump(prepared_data, f, indent=4)
+    write_json(prepared_data, out_path)
 
     print(f"[Step 2.4.1] Created {output_json} at: {out_path}")
     return out_path
@@ -100,7 +283,64 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
 # 2.4.2 - CREATE ORIGINAL CT/MRI NIFTI
 # ----------------------------------------------------------------
 
-def load_dicom_series(series_folder_path):
+def build_affine(iop, spacing, ipp=None):
+    """
+    Voxel-to-patient affine of a slice stack.
+
+    Parameters
+    ----------
+    iop : sequence of 6 floats
+        ImageOrientationPatient (row and column direction cosines); the slice direction
+        is their cross product.
+    spacing : sequence of 3 floats
+        (row spacing, column spacing, slice thickness).
+    ipp : sequence of 3 floats, optional
+        ImagePositionPatient of the first slice (the translation); zero if None.
+    """
+    row_cos = np.asarray(iop[0:3], dtype=np.float64)
+    col_cos = np.asarray(iop[3:6], dtype=np.float64)
+    slice_cos = np.cross(row_cos, col_cos)
+    affine = np.eye(4, dtype=np.float64)
+    affine[:3, :3] = np.column_stack((row_cos, col_cos, slice_cos)) * np.asarray(spacing, dtype=np.float64)
+    if ipp is not None:
+        affine[:3, 3] = np.asarray(ipp, dtype=np.float64)
+    return affine
+
+# Transfer syntaxes whose Pixel Data is the raw little-endian sample array
+NATIVE_LITTLE_ENDIAN_SYNTAXES = {"1.2.840.10008.1.2", "1.2.840.10008.1.2.1"}
+
+def slice_pixels(ds):
+    """
+    2D pixel array of a single-frame grayscale slice.
+
+    Uncompressed little-endian Pixel Data is viewed directly with np.frombuffer, which
+    skips pydicom's pixel handler machinery (and its extra copy); unused high bits are
+    corrected the same way ds.pixel_array does. Anything else uses ds.pixel_array.
+    """
+    meta = getattr(ds, "file_meta", None)
+    syntax = str(getattr(meta, "TransferSyntaxUID", "")) if meta is not None else ""
+    bits = int(getattr(ds, "BitsAllocated", 0) or 0)
+    if (
+        syntax not in NATIVE_LITTLE_ENDIAN_SYNTAXES
+        or bits not in (8, 16, 32)
+        or int(getattr(ds, "SamplesPerPixel", 1) or 1) != 1
+        or int(getattr(ds, "NumberOfFrames", 1) or 1) != 1
+        or "PixelData" not in ds
+    ):
+        return ds.pixel_array
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    arr = np.frombuffer(
+        ds.PixelData, dtype=pixel_dtype_from_header(ds).newbyteorder("<"), count=rows * cols
+    ).reshape(rows, cols)
+    unused = bits - int(getattr(ds, "BitsStored", bits) or bits)
+    if unused > 0:
+        if arr.dtype.kind == "i":
+            arr = (arr << unused) >> unused  # sign-extend from BitsStored
+        else:
+            arr = arr & ((1 << (bits - unused)) - 1)
+    return arr
+
+def load_dicom_series(series_folder_path, dcm_files=None):
     """
     Loads a DICOM series from series_folder_path, returns (volume_3d, affine, dims).
     This is a simplistic approach: we:
@@ -110,15 +350,14 @@ def load_dicom_series(series_folder_path):
      - build an approximate affine using pixel spacing, slice thickness, orientation, etc.
 
     In real practice, you might want a more robust approach or use dcm2niix.
+    dcm_files (the series' .dcm paths) is listed from series_folder_path if not given.
     """
-    import glob
-    dcm_files = sorted(glob.glob(os.path.join(series_folder_path, "*.dcm")))
+    if dcm_files is None:
+        dcm_files = list_dcm_files(series_folder_path)
 
-    # Read all slices
-    slices = []
-    for f in dcm_files:
-        ds = pydicom.dcmread(f, force=True)
-        slices.append(ds)
+    # Read all slices (in parallel; map keeps the file order)
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        slices = list(ex.map(lambda f: pydicom.dcmread(f, force=True), dcm_files))
     if not slices:
         raise RuntimeError(f"No DICOM slices found in {series_folder_path}")
 
@@ -147,37 +386,100 @@ def load_dicom_series(series_folder_path):
         iop = [float(x) for x in sample_ds.ImageOrientationPatient]
 
     n_slices = len(slices)
-    volume_3d = np.zeros((rows, cols, n_slices), dtype=np.int16)
+    # Fortran order: each slice is one contiguous block, and it is NIfTI's on-disk layout,
+    # so nibabel writes the volume without a transposed copy
+    volume_3d = np.empty((rows, cols, n_slices), dtype=np.int16, order="F")
 
     # Fill volume
     for idx, ds in enumerate(slices):
-        arr = ds.pixel_array
+        arr = slice_pixels(ds)
         volume_3d[:, :, idx] = arr
 
     # Build a simple affine
-    # We'll assume no shear for demonstration
-    # The direction cosines are iop[0..2], iop[3..5]
-    # The slice direction can be cross of these two
-    # We won't do a fully robust approach
-    row_cos = np.array(iop[0:3])
-    col_cos = np.array(iop[3:6])
-    # normal direction
-    slice_cos = np.cross(row_cos, col_cos)
+    # We'll assume no shear for demonstration; the slice direction is the cross
+    # product of the row/column direction cosines (not a fully robust approach).
+    # The translation is the first slice's ImagePositionPatient if present.
+    ipp = getattr(slices[0], "ImagePositionPatient", None)
+    affine = build_affine(iop, [px_spacing[0], px_spacing[1], slice_thick], ipp)
+
+    # Remember the slice order and geometry for 2.4.3
+    SERIES_GEOMETRY_CACHE[os.path.abspath(series_folder_path)] = SeriesGeometry(
+        sop_uid_list=[getattr(ds, "SOPInstanceUID", None) for ds in slices],
+        shape=(rows, cols, n_slices),
+        affine=affine,
+        dtype=slice_pixels(slices[0]).dtype
+    )
 
-    # Scale by pixel spacing
-    spacing = np.array([px_spacing[0], px_spacing[1], slice_thick], dtype=float)
-    affine = np.zeros((4, 4), dtype=float)
-    affine[3, 3] = 1.0
-    affine[0:3, 0] = row_cos * spacing[0]
-    affine[0:3, 1] = col_cos * spacing[1]
-    affine[0:3, 2] = slice_cos * spacing[2]
+    return volume_3d, affine, (rows, cols, n_slices)
 
-    # for translation, we can get from first slice's ImagePositionPatient if present
-    if hasattr(slices[0], "ImagePositionPatient"):
-        ipp = [float(x) for x in slices[0].ImagePositionPatient]
-        affine[0:3, 3] = ipp
+def create_series_nifti(series_info, out_dir, overwrite=False):
+    """
+    2.4.2 for one series: load the DICOM series of series_info and save it as
+    "<series_number>.nii" in out_dir (skipping an existing file unless overwrite=True).
 
-    return volume_3d, affine, (rows, cols, n_slices)
+    Returns
+    -------
+    bool
+        True if the .nii exists afterwards (created or skipped), False if the series
+        path is invalid or the series could not be loaded.
+    """
+    series_number = series_info.get("series_number")
+    series_path = series_info.get("series_folder_path")
+    dcm_files = series_dcm_files(series_info)
+
+    if not series_path or dcm_files is None:
+        print(f"Skipping series {series_number} - invalid path {series_path}")
+        return False
+
+    # Build name
+    nii_name = f"{series_number}.nii"
+    nii_path = os.path.join(out_dir, nii_name)
+
+    # If file exists, do shape check
+    # (from its manifest when there is one; older outputs are opened with nibabel)
+    manifest = None if overwrite else read_manifest(nii_path)
+    if manifest is not None:
+        # Skip only if it was made from the series as it is now: same shape and slice
+        # SOP UIDs as a header-only read of the current .dcm files
+        try:
+            geometry = load_sop_uid_order(series_path, dcm_files)
+        except Exception:
+            geometry = None
+        if (geometry is not None and manifest["shape"] == tuple(geometry.shape)
+                and manifest.get("sop_hash") == sop_uid_hash(geometry.sop_uid_list)):
+            SERIES_GEOMETRY_CACHE[os.path.abspath(series_path)] = geometry
+            print(f"[2.4.2] Found existing {nii_name} with shape {manifest['shape']}, skipping creation.")
+            return True
+    elif os.path.exists(nii_path) and not overwrite:
+        try:
+            existing_img = nib.load(nii_path)
+            shape_exists = existing_img.shape
+            # We'll assume this shape must match
+            # (rows, cols, slices). If it does, skip
+            # Otherwise we proceed to re-create
+            # This is your policy to skip or not
+            print(f"[2.4.2] Found existing {nii_name} with shape {shape_exists}, skipping creation.")
+            return True
+        except:
+            pass
+
+    # Load the dicom series
+    try:
+        vol_3d, aff, dims = load_dicom_series(series_path, dcm_files)
+    except Exception as e:
+        print(f"Error loading DICOM series {series_number} from {series_path}: {e}")
+        return False
+
+    # Save as nifti
+    nifti_img = nib.Nifti1Image(vol_3d, aff)
+    nib.save(nifti_img, nii_path)
+    geometry = SERIES_GEOMETRY_CACHE[os.path.abspath(series_path)]
+    write_manifest(nii_path, vol_3d.shape, vol_3d.dtype, geometry.sop_uid_list)
+    save_series_geometry(
+        geometry, series_path, os.path.join(out_dir, f"{series_number}.sopuids.json")
+    )
+    print(f"[2.4.2] Created {nii_name} with shape {vol_3d.shape} at {nii_path}")
+    return True
 
 def step_2_4_2_create_original_nifti(ready2nifti_json_path, overwrite=False):
     """
@@ -193,8 +495,7 @@ def step_2_4_2_create_original_nifti(ready2nifti_json_path, overwrite=False):
     overwrite : bool
         Whether to overwrite existing .nii if same shape. Default False.
     """
-    with open(ready2nifti_json_path, "r") as f:
-        data = json.load(f)
+    data = read_json(ready2nifti_json_path)
 
     seg_dict = data.get("selected_segmentations", {})
     base_dir = os.path.dirname(os.path.abspath(ready2nifti_json_path))
@@ -202,62 +503,425 @@ def step_2_4_2_create_original_nifti(ready2nifti_json_path, overwrite=False):
     os.makedirs(out_dir, exist_ok=True)
 
     # We'll keep track of which series we have already processed
-    processed_series = {}
+    processed_series = set()
 
     for seg_folder_name, seg_info in seg_dict.items():
         series_info = seg_info.get("series_info")
         if not series_info:
             continue
 
-        series_number = series_info.get("series_number")
-        series_path = series_info.get("series_folder_path")
-
-        if not series_path or not os.path.isdir(series_path):
-            print(f"Skipping series {series_number} - invalid path {series_path}")
-            continue
-
         # If we haven't processed this series yet, create the .nii
-        if series_number in processed_series:
+        if series_info.get("series_number") in processed_series:
             continue  # already done
+        if create_series_nifti(series_info, out_dir, overwrite):
+            processed_series.add(series_info.get("series_number"))
 
-        # Build name
-        nii_name = f"{series_number}.nii"
-        nii_path = os.path.join(out_dir, nii_name)
 
-        # If file exists, do shape check
-        if os.path.exists(nii_path) and not overwrite:
-            try:
-                existing_img = nib.load(nii_path)
-                shape_exists = existing_img.shape
-                # We'll assume this shape must match
-                # (rows, cols, slices). If it does, skip
-                # Otherwise we proceed to re-create
-                # This is your policy to skip or not
-                processed_series[series_number] = nii_path
-                print(f"[2.4.2] Found existing {nii_name} with shape {shape_exists}, skipping creation.")
-                continue
-            except:
-                pass
-
-        # Load the dicom series
+# ----------------------------------------------------------------
+# 2.4.3 - CREATE SEGMENTATION NIFTI
+# ----------------------------------------------------------------
+
+# Header tags load_sop_uid_order needs; pydicom skips every other element
+SERIES_HEADER_TAGS = [
+    "InstanceNumber", "SOPInstanceUID", "Rows", "Columns", "PixelSpacing", "SliceThickness",
+    "ImageOrientationPatient", "ImagePositionPatient", "BitsAllocated", "PixelRepresentation"
+]
+
+def pixel_dtype_from_header(ds):
+    """
+    dtype of ds.pixel_array for plain grayscale data, derived from BitsAllocated and
+    PixelRepresentation (int16 if they are missing).
+    """
+    bits = int(getattr(ds, "BitsAllocated", 16) or 16)
+    signed = int(getattr(ds, "PixelRepresentation", 1) or 0) == 1
+    return np.dtype(f"{'i' if signed else 'u'}{max(bits, 8) // 8}")
+
+def load_sop_uid_order(series_path, dcm_files=None):
+    """
+    Read the slice order and geometry (a SeriesGeometry) of the DICOM series in series_path
+    (from dcm_files if given, else from the .dcm files listed in series_path).
+    """
+    if dcm_files is None:
+        dcm_files = list_dcm_files(series_path)
+    if not dcm_files:
+        raise RuntimeError("No DICOMs found.")
+    # read the headers only (stop before Pixel Data, skip everything not listed), sort
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        slices = list(ex.map(
+            lambda f: pydicom.dcmread(f, force=True, stop_before_pixels=True, specific_tags=SERIES_HEADER_TAGS),
+            dcm_files
+        ))
+    slices.sort(key=lambda ds: getattr(ds, "InstanceNumber", 0))
+
+    sop_list = []
+    rows = slices[0].Rows
+    cols = slices[0].Columns
+    px_spacing = getattr(slices[0], "PixelSpacing", [1.0, 1.0])
+    slice_thick = getattr(slices[0], "SliceThickness", 1.0)
+
+    # orientation
+    iop = getattr(slices[0], "ImageOrientationPatient", [1,0,0,0,1,0])
+    aff = build_affine(
+        iop, [px_spacing[0], px_spacing[1], slice_thick],
+        getattr(slices[0], "ImagePositionPatient", None)
+    )
+
+    for s in slices:
+        sop_list.append(getattr(s, "SOPInstanceUID", None))
+
+    # The dtype pixel_array would have, from the header (no pixel decoding needed)
+    vol_dtype = pixel_dtype_from_header(slices[0])
+
+    shape_ = (rows, cols, len(slices))
+    return SeriesGeometry(sop_uid_list=sop_list, shape=shape_, affine=aff, dtype=vol_dtype)
+
+
+if njit is not None:
+    # Compiled on first use, not at import; cache=True keeps the machine code on disk,
+    # so only the first run pays the compile time
+    @njit(parallel=True, cache=True)
+    def _scatter_masks_kernel(out, frames, idx):
+        # out: (rows, cols, slices) volume; frames[k] goes to slice idx[k].
+        # Parallel over rows, so frames that hit the same slice are still
+        # written in order (the last one wins, as in the sequential loop).
+        for r in prange(out.shape[0]):
+            for k in range(idx.shape[0]):
+                s = idx[k]
+                for c in range(out.shape[1]):
+                    out[r, c, s] = frames[k, r, c]
+
+    @njit(parallel=True, cache=True)
+    def _scatter_packed_masks_kernel(out, packed, idx):
+        # Same as _scatter_masks_kernel, but frames are np.packbits rows (MSB first)
+        # of the row-major (rows, cols) mask, unpacked bit by bit while writing.
+        cols = out.shape[1]
+        for r in prange(out.shape[0]):
+            for k in range(idx.shape[0]):
+                s = idx[k]
+                for c in range(cols):
+                    bit = r * cols + c
+                    out[r, c, s] = (packed[k, bit >> 3] >> (7 - (bit & 7))) & 1
+
+def scatter_masks(out, frames, idx):
+    """
+    Write 2D masks into the slices of a 3D volume.
+
+    Parameters
+    ----------
+    out : np.ndarray
+        (rows, cols, slices) uint8 volume, written in place.
+    frames : np.ndarray
+        (n_frames, rows, cols) uint8 stack of masks.
+    idx : np.ndarray
+        int64 array of length n_frames; frames[k] is written to out[:, :, idx[k]].
+    """
+    if njit is not None:
+        _scatter_masks_kernel(out, frames, idx)
+    else:
+        for k in range(idx.shape[0]):
+            out[:, :, idx[k]] = frames[k]
+
+def scatter_packed_masks(out, packed, idx):
+    """
+    scatter_masks() for bit-packed masks: packed is the (n_frames, n_bytes) uint8 stack
+    of np.packbits-packed frames. They are unpacked as they are written (one frame at a
+    time without numba), so the masks never exist unpacked all at once.
+    """
+    if njit is not None:
+        _scatter_packed_masks_kernel(out, packed, idx)
+    else:
+        rows, cols = out.shape[0], out.shape[1]
+        for k in range(idx.shape[0]):
+            out[:, :, idx[k]] = np.unpackbits(packed[k], count=rows * cols).reshape(rows, cols)
+
+def _init_seg_worker():
+    """Pool initializer: one numba thread per worker, as the workers already fill the cores."""
+    if njit is not None:
+        set_num_threads(1)
+
+def seg_worker_pool(workers):
+    """
+    ProcessPoolExecutor for 2.4.3. Workers are spawned rather than forked, since numba's
+    threading layer is not fork-safe once the parent process has started it.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_seg_worker
+    )
+
+def create_mask_memmap(nii_path, shape, affine):
+    """
+    Create an uncompressed uint8 NIfTI at nii_path filled with zeros and return its voxel
+    data as a writable Fortran-ordered np.memmap (flush() it when done).
+
+    The header is the one nib.save would write for a uint8 volume of this shape; the data
+    block is allocated by extending the file, so the volume never has to exist in RAM.
+    """
+    header = nib.Nifti1Image(np.broadcast_to(np.uint8(0), shape), affine).header
+    header.set_slope_inter(1.0, 0.0)  # what nib.save stores for unscaled uint8 data
+    with open(nii_path, "wb") as f:
+        header.write_to(f)
+        offset = f.tell()
+        f.truncate(offset + int(np.prod(shape)))
+    return np.memmap(nii_path, dtype=np.uint8, mode="r+", offset=offset, shape=tuple(shape), order="F")
+
+def gzip_file(src_path, dst_path):
+    """
+    Gzip src_path into dst_path (nibabel's compression level 1), with pigz on all
+    cores when it is installed and the gzip module otherwise.
+    """
+    pigz = shutil.which("pigz")
+    if pigz:
+        with open(dst_path, "wb") as out:
+            subprocess.run(
+                [pigz, "-1", "-c", "-p", str(os.cpu_count() or 1), src_path],
+                stdout=out, check=True
+            )
+    else:
+        with open(src_path, "rb") as src, gzip.open(dst_path, "wb", compresslevel=1) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+def map_sop_uids_to_slices(geometry, frame_uids):
+    """
+    Slice index of each frame's ref_sop_uid in one vectorized lookup.
+
+    Every frame UID is found in the series' sorted UIDs (sop_uid_lookup()) with
+    np.searchsorted. Returns an int64 array with -1 for frames whose UID is not in
+    the series.
+    """
+    sorted_sop, order = sop_uid_lookup(geometry)
+    uids = np.array([str(u) for u in frame_uids])
+    if sorted_sop.size == 0 or uids.size == 0:
+        return np.full(uids.size, -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_sop, uids, side="right") - 1
+    pos_ok = np.maximum(pos, 0)
+    found = (pos >= 0) & (sorted_sop[pos_ok] == uids)
+    return np.where(found, order[pos_ok], -1)
+
+def frames_to_arrays(frames):
+    """
+    Structure-of-arrays view of the frame fields 2.4.3 uses, built in one pass.
+
+    Returns
+    -------
+    dict
+        "ref_sop_uid" (list), "segment_name" (str array), "has_pixels" (bool array) and
+        "pixel_shape" ((n_frames, 2) int64 array of the unpacked (rows, cols); 0 when a
+        frame has no pixel data).
+    """
+    n = len(frames)
+    arrays = {
+        "ref_sop_uid": [None] * n,
+        "segment_name": [None] * n,
+        "has_pixels": np.zeros(n, dtype=bool),
+        "pixel_shape": np.zeros((n, 2), dtype=np.int64),
+    }
+    for i, fr in enumerate(frames):
+        arrays["ref_sop_uid"][i] = fr.get("ref_sop_uid", None)
+        arrays["segment_name"][i] = str(fr.get("segment_name", "UnknownSEG"))
+        px = fr.get("pixel_data")
+        if px is not None:
+            arrays["has_pixels"][i] = True
+            shape = fr.get("pixel_shape") or px.shape
+            arrays["pixel_shape"][i] = shape[:2]
+    arrays["segment_name"] = np.array(arrays["segment_name"], dtype=str)
+    return arrays
+
+def stack_masks(frames, frame_ids):
+    """
+    The pixel_data of frames[frame_ids] as one contiguous stack: (n, rows, cols) uint8
+    masks, or (n, n_bytes) rows for bit-packed frames (kept packed).
+    """
+    return np.stack([frames[k]["pixel_data"] for k in frame_ids]).astype(np.uint8, copy=False)
+
+def resample_frame(pixel_data, frame_shape, rows, cols, is_packed):
+    """
+    Nearest-neighbour resample of a frame's mask from frame_shape to (rows, cols),
+    returned in the frame's own encoding (packed rows stay np.packbits-packed).
+    """
+    h, w = int(frame_shape[0]), int(frame_shape[1])
+    mask = np.unpackbits(pixel_data, count=h * w).reshape(h, w) if is_packed else np.asarray(pixel_data)
+    mask = mask[np.ix_((np.arange(rows) * h) // rows, (np.arange(cols) * w) // cols)]
+    return np.packbits(mask.reshape(-1)) if is_packed else mask
+
+def create_seg_nifti(seg_folder_name, seg_info, out_dir, overwrite=False, geometry=None, compress=False):
+    """
+    2.4.3 for one segmentation: build and save a mask NIfTI for each segment_name of
+    its pkl_file in out_dir (skipping up-to-date outputs unless overwrite=True).
+    geometry is the SeriesGeometry of its series if the caller already has it;
+    compress=True writes .nii.gz instead of .nii.
+    """
+    pkl_file = seg_info.get("pkl_file")
+    series_info = seg_info.get("series_info") or {}
+    if not pkl_file or not os.path.exists(pkl_file):
+        print(f"Skipping {seg_folder_name} - pkl_file missing or not found.")
+        return
+    series_number = series_info.get("series_number")
+    series_path = series_info.get("series_folder_path")
+    dcm_files = series_dcm_files(series_info) if geometry is None else None
+    if not series_number or not series_path or (geometry is None and dcm_files is None):
+        print(f"Skipping {seg_folder_name} - invalid series info.")
+        return
+
+    # Load the frames from the pickle
+    seg_data = load_pickle(pkl_file)
+    frames = seg_data.get("frames", [])
+    is_packed = seg_data.get("pixel_encoding") == "packbits"
+    # The segmentation might have multiple distinct segment_name. We'll gather them
+    # "segment_name" -> frame indices (and each frame -> slice index)
+    # but first we need the original series SOP order
+    if geometry is None:
         try:
-            vol_3d, aff, dims = load_dicom_series(series_path)
+            geometry = load_series_geometry(
+                series_path, os.path.join(out_dir, f"{series_number}.sopuids.json"), dcm_files
+            )
         except Exception as e:
-            print(f"Error loading DICOM series {series_number} from {series_path}: {e}")
-            continue
-
-        # Save as nifti
-        nifti_img = nib.Nifti1Image(vol_3d, aff)
-        nib.save(nifti_img, nii_path)
-        processed_series[series_number] = nii_path
-        print(f"[2.4.2] Created {nii_name} with shape {vol_3d.shape} at {nii_path}")
+            print(f"Unable to load series info for {series_number}: {e}")
+            return
 
+    sop_uid_list, shape_, aff_, vol_dtype_ = (
+        geometry.sop_uid_list, geometry.shape, geometry.affine, geometry.dtype
+    )
+    # shape_ = (rows, cols, slices)
+    # Map every frame's ref_sop_uid to its index in that slice dimension at once
+    arrays = frames_to_arrays(frames)
+    frame_slices = map_sop_uids_to_slices(geometry, arrays["ref_sop_uid"])
+    placeable = np.flatnonzero(arrays["has_pixels"] & (frame_slices >= 0))
+
+    # Group the placeable frames by segment_name (groups in order of first appearance,
+    # frames in their original order); packed frames stay packed until they are placed
+    seg_names = arrays["segment_name"][placeable]
+    segment_groups = []
+    if placeable.size:
+        names, first, inverse = np.unique(seg_names, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[order] = np.arange(len(names))
+        group_of = rank[inverse]
+        grouped = placeable[np.argsort(group_of, kind="stable")]
+        bounds = np.cumsum(np.bincount(group_of, minlength=len(names)))[:-1]
+        segment_groups = list(zip(names[order].tolist(), np.split(grouped, bounds)))
+
+    series_sop_hash = sop_uid_hash(sop_uid_list)
+    for seg_name, frame_ids in segment_groups:
+        # filename = {series_number}_ON_{seg_name}__FN_{folder_name}.nii
+        nii_name = f"{series_number}_ON_{seg_name}__FN_{seg_folder_name}.nii"
+        if compress:
+            nii_name += ".gz"
+        nii_path = os.path.join(out_dir, nii_name)
+        if not overwrite:
+            # Skip if it was created for this series layout (per its manifest);
+            # outputs without a manifest are opened to compare the shape
+            manifest = read_manifest(nii_path)
+            if manifest is not None:
+                if manifest["shape"] == tuple(shape_) and manifest.get("sop_hash") == series_sop_hash:
+                    print(f"[2.4.3] Found existing {nii_name} with shape {manifest['shape']}, skipping creation.")
+                    continue
+            elif os.path.exists(nii_path):
+                try:
+                    existing = nib.load(nii_path)
+                    if existing.shape == shape_:
+                        print(f"[2.4.3] Found existing {nii_name} with shape {existing.shape}, skipping creation.")
+                        continue
+                except Exception:
+                    pass
 
-# ----------------------------------------------------------------
-# 2.4.3 - CREATE SEGMENTATION NIFTI
-# ----------------------------------------------------------------
+        # Check all the frame shapes against the series (rows, cols) at once; frames that
+        # do not fit are resampled to it (nearest neighbour) instead of being dropped
+        fits = (arrays["pixel_shape"][frame_ids] == shape_[:2]).all(axis=1)
+        if fits.all():
+            stack = stack_masks(frames, frame_ids)
+        else:
+            pixels = []
+            for k, fit in zip(frame_ids, fits):
+                px = frames[k]["pixel_data"]
+                if not fit:
+                    frame_shape = tuple(int(x) for x in arrays["pixel_shape"][k])
+                    print(
+                        f"WARNING: mismatch shape in seg {seg_folder_name}, segment {seg_name}, "
+                        f"slice {frame_slices[k]}: resampling {frame_shape} to {tuple(shape_[:2])}"
+                    )
+                    px = resample_frame(px, frame_shape, shape_[0], shape_[1], is_packed)
+                pixels.append(px)
+            stack = np.stack(pixels).astype(np.uint8, copy=False)
+
+        # Write the NIfTI in place: a zero-filled file, memory-mapped, with each 2D mask
+        # placed directly into its pages (written to a temporary name, then renamed)
+        tmp_path = (nii_path[:-3] if compress else nii_path) + ".tmp"
+        mask_3d = create_mask_memmap(tmp_path, shape_, aff_)
+        if frame_ids.size:
+            # bit-packed masks stay packed (1/8 of the memory) until written into the file
+            scatter = scatter_packed_masks if is_packed else scatter_masks
+            scatter(mask_3d.view(np.ndarray), stack, frame_slices[frame_ids])
+        mask_3d.flush()
+        del mask_3d
+        if compress:
+            # masks are mostly zeros, so they compress very well
+            gzip_file(tmp_path, nii_path + ".tmp")
+            os.remove(tmp_path)
+            tmp_path = nii_path + ".tmp"
+        os.replace(tmp_path, nii_path)
+        write_manifest(nii_path, shape_, np.uint8, sop_uid_list)
+        print(f"[2.4.3] Created {nii_name} with shape {tuple(shape_)}")
+
+def create_seg_niftis(seg_dict, names, out_dir, overwrite=False, compress=False, executor=None):
+    """
+    Run create_seg_nifti for the segmentations seg_dict[name] for name in names,
+    in parallel worker processes.
 
-def step_2_4_3_create_seg_nifti(ready2nifti_json_path, overwrite=False):
+    With executor (a ProcessPoolExecutor shared by several calls) the jobs are submitted
+    to it and their futures are returned without waiting; otherwise this call runs them
+    to completion and returns an empty list.
+    """
+    # The slice order of each referenced series is loaded once, here: load_series_geometry()
+    # caches it per series (and reuses what 2.4.2 read); failures are reported per
+    # segmentation by create_seg_nifti
+    geometries = []
+    for seg_folder_name in names:
+        series_info = seg_dict[seg_folder_name].get("series_info") or {}
+        series_number = series_info.get("series_number")
+        series_path = series_info.get("series_folder_path")
+        geometry = None
+        dcm_files = series_dcm_files(series_info) if series_number and series_path else None
+        if dcm_files is not None:
+            try:
+                geometry = load_series_geometry(
+                    series_path, os.path.join(out_dir, f"{series_number}.sopuids.json"), dcm_files
+                )
+                sop_uid_lookup(geometry)  # build it once here rather than in every worker
+            except Exception:
+                geometry = None
+        geometries.append(geometry)
+
+    # Segmentations are independent (own pkl file, own output files), so they are
+    # processed in parallel worker processes
+    if executor is not None:
+        return [
+            executor.submit(
+                create_seg_nifti, seg_folder_name, seg_dict[seg_folder_name], out_dir,
+                overwrite, geometry, compress
+            )
+            for seg_folder_name, geometry in zip(names, geometries)
+        ]
+    workers = min(SEG_WORKERS, len(names))
+    if workers > 1:
+        with seg_worker_pool(workers) as ex:
+            list(ex.map(
+                create_seg_nifti,
+                names,
+                [seg_dict[n] for n in names],
+                repeat(out_dir),
+                repeat(overwrite),
+                geometries,
+                repeat(compress)
+            ))
+    else:
+        for seg_folder_name, geometry in zip(names, geometries):
+            create_seg_nifti(seg_folder_name, seg_dict[seg_folder_name], out_dir, overwrite, geometry, compress)
+    return []
+
+def step_2_4_3_create_seg_nifti(ready2nifti_json_path, overwrite=False, compress=False):
     """
     For each selected segmentation in Ready2Nifti_info.json, we:
      - load its pkl_file with frames[]
@@ -267,145 +931,59 @@ def step_2_4_3_create_seg_nifti(ready2nifti_json_path, overwrite=False):
      - store as e.g. "{series_number}_ON_{segment_name}__FN_{folder_name}.nii" in NIFTI.
 
     We skip creation if the file exists and shape matches (unless overwrite=True).
+    With compress=True the masks are saved as ".nii.gz" (gzip-compressed with pigz
+    when it is installed) instead of ".nii".
     """
-    with open(ready2nifti_json_path, "r") as f:
-        data = json.load(f)
+    data = read_json(ready2nifti_json_path)
 
     seg_dict = data.get("selected_segmentations", {})
     base_dir = os.path.dirname(os.path.abspath(ready2nifti_json_path))
     out_dir = os.path.join(base_dir, "NIFTI")
     os.makedirs(out_dir, exist_ok=True)
 
-    # We need slice order from the original series to match frames' ref_sop_uid
-    # Let's build a cache: series_number -> [list of SOPInstanceUID in correct order]
-    # plus the shape & affine
-    # We'll rely on the same load_dicom_series() approach from step_2_4_2,
-    # but we also store each slice ds.SOPInstanceUID
-    from collections import defaultdict
-    series_sop_uids_cache = {}  # { series_number: (sop_uid_list, shape, aff) }
-
-    def load_sop_uid_order(series_path):
-        """Return (list_of_sop_uid_in_order, shape, affine, volume_3d_dtype) for the given series path."""
-        import glob
-        dcm_files = sorted(glob.glob(os.path.join(series_path, "*.dcm")))
-        if not dcm_files:
-            raise RuntimeError("No DICOMs found.")
-        # read all, sort
-        slices = []
-        for f in dcm_files:
-            ds = pydicom.dcmread(f, force=True)
-            slices.append(ds)
-        slices.sort(key=lambda ds: getattr(ds, "InstanceNumber", 0))
-
-        sop_list = []
-        rows = slices[0].Rows
-        cols = slices[0].Columns
-        px_spacing = getattr(slices[0], "PixelSpacing", [1.0, 1.0])
-        slice_thick = getattr(slices[0], "SliceThickness", 1.0)
-
-        # orientation
-        iop = getattr(slices[0], "ImageOrientationPatient", [1,0,0,0,1,0])
-        row_cos = np.array(iop[0:3])
-        col_cos = np.array(iop[3:6])
-        slice_cos = np.cross(row_cos, col_cos)
-
-        spacing = np.array([px_spacing[0], px_spacing[1], slice_thick], dtype=float)
-        aff = np.zeros((4,4), dtype=float)
-        aff[3,3] = 1.0
-        aff[0:3,0] = row_cos * spacing[0]
-        aff[0:3,1] = col_cos * spacing[1]
-        aff[0:3,2] = slice_cos * spacing[2]
-        if hasattr(slices[0], "ImagePositionPatient"):
-            ipp = [float(x) for x in slices[0].ImagePositionPatient]
-            aff[0:3,3] = ipp
-
-        for s in slices:
-            sop_list.append(getattr(s, "SOPInstanceUID", None))
-
-        # We'll also keep the dtype from pixel_array
-        test_arr = slices[0].pixel_array
-        vol_dtype = test_arr.dtype
-
-        shape_ = (rows, cols, len(slices))
-        return sop_list, shape_, aff, vol_dtype
+    create_seg_niftis(seg_dict, list(seg_dict), out_dir, overwrite, compress)
 
-    for seg_folder_name, seg_info in seg_dict.items():
-        pkl_file = seg_info.get("pkl_file")
-        series_info = seg_info.get("series_info", {})
-        if not pkl_file or not os.path.exists(pkl_file):
-            print(f"Skipping {seg_folder_name} - pkl_file missing or not found.")
-            continue
-        series_number = series_info.get("series_number")
-        series_path = series_info.get("series_folder_path")
-        if not series_number or not series_path or not os.path.isdir(series_path):
-            print(f"Skipping {seg_folder_name} - invalid series info.")
-            continue
+def step_2_4_combined(ready2nifti_json_path, overwrite=False, compress=False):
+    """
+    2.4.2 and 2.4.3 in one pass over the series: for each referenced series, create its
+    "<series_number>.nii" and then, while its slice order and geometry are still at hand,
+    the mask NIfTIs of every segmentation that references it. Output is the same as
+    running step_2_4_2_create_original_nifti and then step_2_4_3_create_seg_nifti.
 
-        # Load the frames from the pickle
-        with open(pkl_file, "rb") as pf:
-            seg_data = pickle.load(pf)
-        frames = seg_data.get("frames", [])
-        # The segmentation might have multiple distinct segment_name. We'll gather them
-        # "segment_name" -> list of (slice_idx, 2D mask)
-        # but first we need the original series SOP order
-        if series_number not in series_sop_uids_cache:
-            try:
-                sop_uid_list, shape_, aff_, vol_dtype_ = load_sop_uid_order(series_path)
-                series_sop_uids_cache[series_number] = (sop_uid_list, shape_, aff_, vol_dtype_)
-            except Exception as e:
-                print(f"Unable to load series info for {series_number}: {e}")
-                continue
-
-        sop_uid_list, shape_, aff_, vol_dtype_ = series_sop_uids_cache[series_number]
-        # shape_ = (rows, cols, slices)
-        # We'll build a mapping from sop_uid -> index in that slice dimension
-        sop_uid_to_index = {}
-        for i, suid in enumerate(sop_uid_list):
-            sop_uid_to_index[suid] = i
-
-        # Group frames by segment_name
-        from collections import defaultdict
-        segment_frames_map = defaultdict(list)
-        for fr in frames:
-            seg_name = fr.get("segment_name", "UnknownSEG")
-            sopid = fr.get("ref_sop_uid", None)
-            frame_2d = fr.get("pixel_data", None)
-            # find slice index
-            if sopid in sop_uid_to_index and frame_2d is not None:
-                slice_index = sop_uid_to_index[sopid]
-                segment_frames_map[seg_name].append((slice_index, frame_2d))
-
-        # For each segment_name, build a 3D mask
-        # shape = shape_
-        # typically it's a binary mask
-        for seg_name, slices_info in segment_frames_map.items():
-            # Create a 3D array of zeros
-            mask_3d = np.zeros(shape_, dtype=np.uint8)
-
-            # place each 2D mask
-            for slice_idx, mask_2d in slices_info:
-                # mask_2d shape => (rows, cols)
-                if mask_2d.shape[0] == shape_[0] and mask_2d.shape[1] == shape_[1]:
-                    mask_3d[:, :, slice_idx] = mask_2d
-                else:
-                    print(f"WARNING: mismatch shape in seg {seg_folder_name}, segment {seg_name}, slice {slice_idx}")
-
-            # Now save as NIfTI
-            # filename = {series_number}_ON_{seg_name}__FN_{folder_name}.nii
-            nii_name = f"{series_number}_ON_{seg_name}__FN_{seg_folder_name}.nii"
-            nii_path = os.path.join(out_dir, nii_name)
-            if os.path.exists(nii_path) and not overwrite:
-                try:
-                    existing = nib.load(nii_path)
-                    if existing.shape == shape_:
-                        print(f"[2.4.3] Found existing {nii_name} with shape {existing.shape}, skipping creation.")
-                        continue
-                except:
-                    pass
+    Parameters
+    ----------
+    ready2nifti_json_path : str
+        Path to the Ready2Nifti_info.json
+    overwrite : bool
+        Whether to overwrite existing NIfTIs. Default False.
+    compress : bool
+        Save the masks as ".nii.gz" instead of ".nii". Default False.
+    """
+    data = read_json(ready2nifti_json_path)
+
+    seg_dict = data.get("selected_segmentations", {})
+    base_dir = os.path.dirname(os.path.abspath(ready2nifti_json_path))
+    out_dir = os.path.join(base_dir, "NIFTI")
+    os.makedirs(out_dir, exist_ok=True)
 
-            nifti_img = nib.Nifti1Image(mask_3d, aff_)
-            nib.save(nifti_img, nii_path)
-            print(f"[2.4.3] Created {nii_name} with shape {mask_3d.shape}")
+    # Group the segmentations by series (series in order of first reference)
+    series_groups = {}
+    for seg_folder_name, seg_info in seg_dict.items():
+        series_number = (seg_info.get("series_info") or {}).get("series_number")
+        series_groups.setdefault(series_number, []).append(seg_folder_name)
+
+    # One worker pool for the whole study: each series' mask jobs are submitted as soon as
+    # its .nii and geometry are ready, and run while the next series is loaded here
+    workers = min(SEG_WORKERS, len(seg_dict))
+    with (seg_worker_pool(workers) if workers > 1 else nullcontext()) as executor:
+        futures = []
+        for series_number, names in series_groups.items():
+            series_info = seg_dict[names[0]].get("series_info")
+            if series_info:
+                create_series_nifti(series_info, out_dir, overwrite)
+            futures += create_seg_niftis(seg_dict, names, out_dir, overwrite, compress, executor)
+        for future in futures:
+            future.result()  # re-raise worker errors, as the per-series pools did
 
 # ----------------------------------------------------------------
 # Main script combining the three steps
@@ -431,12 +1009,11 @@ def main():
         output_json="Ready2Nifti_info.json"
     )
 
-    # Step 2.4.2
+    # Steps 2.4.2 + 2.4.3, in one pass per series
+    # (step_2_4_2_create_original_nifti / step_2_4_3_create_seg_nifti run them separately)
     # In the future, you can pass overwrite=True if you want to forcibly re-generate
-    step_2_4_2_create_original_nifti(ready2nifti_json_path=ready2nifti_path, overwrite=False)
-
-    # Step 2.4.3
-    step_2_4_3_create_seg_nifti(ready2nifti_json_path=ready2nifti_path, overwrite=False)
+    # Pass compress=True to save the masks as .nii.gz
+    step_2_4_combined(ready2nifti_json_path=ready2nifti_path, overwrite=False, compress=False)
 
 
 if __name__ == "__main__":
@@ -27,12 +27,113 @@ Note: Requires pynrrd (install via: pip install pynrrd)
 
 import os
 import sys
+import glob
+import gzip
 import json
 import pickle
+import multiprocessing
 import pydicom
 import numpy as np
-import nibabel as nib  # only used for affine extraction, if needed
 import nrrd           # requires: pip install pynrrd
+from dataclasses import dataclass, field
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; JSON is then read and written with the stdlib json module
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None  # optional; masks are then placed slice by slice with NumPy
+
+# Worker threads used to read the files of a DICOM series (latency-bound I/O)
+READ_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+
+# Worker processes used to build the series (2.4.2) and segmentation (2.4.3) NRRDs
+PROCESS_WORKERS = os.cpu_count() or 1
+
+def read_json(path):
+    """Load a JSON file, with orjson if installed, else the json module."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def write_json(obj, path):
+    """Write obj to path as JSON indented by 2, with orjson if installed, else the json module."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+def load_pickle(pkl_path):
+    """
+    Load a segmentation pickle. Handles both plain pickles and the gzip-compressed
+    pickles written by Step_2_3 and ConcatMultiplObjects (detected by the gzip magic bytes).
+    """
+    with open(pkl_path, "rb") as pf:
+        magic = pf.read(2)
+        pf.seek(0)
+        if magic == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=pf, mode="rb") as gz:
+                return pickle.load(gz)
+        return pickle.load(pf)
+
+def _init_worker():
+    """Pool initializer: one numba thread per worker, as the workers already fill the cores."""
+    if njit is not None:
+        set_num_threads(1)
+
+def worker_pool(workers):
+    """
+    ProcessPoolExecutor for 2.4.2 and 2.4.3. Workers are spawned rather than forked, since
+    numba's threading layer is not fork-safe once the parent process has started it.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker
+    )
+
+@dataclass
+class SeriesGeometry:
+    """Slice order and geometry of a DICOM series: what 2.4.3 needs to place mask frames."""
+    sop_uid_list: list  # SOPInstanceUID of each slice, in volume order
+    shape: tuple        # (rows, cols, slices)
+    affine: np.ndarray
+    dtype: np.dtype     # dtype of the slices' pixel_array
+    # (sorted SOP UIDs, their slice indices) for np.searchsorted lookups; built once per
+    # series by sop_uid_lookup()
+    sop_lookup: tuple = field(default=None, repr=False, compare=False)
+
+def sop_uid_lookup(geometry):
+    """
+    The (sorted_uids, slice_indices) arrays used to map SOP UIDs to slices, built on
+    first use and kept on the SeriesGeometry, so all segmentations of a series share it.
+    When a UID appears on several slices, the last slice is used.
+    """
+    if geometry.sop_lookup is None:
+        sop_arr = np.array([str(u) for u in geometry.sop_uid_list])
+        order = np.argsort(sop_arr, kind="stable")
+        geometry.sop_lookup = (sop_arr[order], order.astype(np.int64))
+    return geometry.sop_lookup
+
+# abspath(series_folder_path) -> SeriesGeometry of every series read in this process, so
+# neither the existing-file check of 2.4.2 nor 2.4.3 reads the DICOMs again
+SERIES_GEOMETRY_CACHE = {}
+
+def load_series_geometry(series_folder_path):
+    """SeriesGeometry of a series: from the in-process cache, else by reading the DICOM headers."""
+    key = os.path.abspath(series_folder_path)
+    geometry = SERIES_GEOMETRY_CACHE.get(key)
+    if geometry is None:
+        geometry = load_sop_uid_order(series_folder_path)
+        SERIES_GEOMETRY_CACHE[key] = geometry
+    return geometry
 
 # ----------------------------------------------------------------
 # 2.4.1 - MATCH REF_SERIES_UID AND CREATE Ready2Nifti_info.json
@@ -46,20 +147,20 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
 
     Returns the path to the created Ready2Nifti_info.json.
     """
-    with open(prepared_json_path, "r") as f:
-        prepared_data = json.load(f)
-    with open(study_series_json_path, "r") as f:
-        study_series_data = json.load(f)
+    prepared_data = read_json(prepared_json_path)
+    study_series_data = read_json(study_series_json_path)
     seg_dict = prepared_data.get("selected_segmentations", {})
+    # Index the SCANS entries by series_uid once (the first entry wins for duplicate UIDs)
+    series_by_uid = {}
+    for series_info in study_series_data.values():
+        series_uid = series_info.get("series_uid")
+        if series_uid:
+            series_by_uid.setdefault(series_uid, series_info)
     for seg_folder_name, seg_info in seg_dict.items():
         ref_uid = seg_info.get("ref_series_uid", None)
         if not ref_uid:
             continue
-        matched_series_info = None
-        for series_info in study_series_data.values():
-            if series_info.get("series_uid") == ref_uid:
-                matched_series_info = series_info
-                break
+        matched_series_info = series_by_uid.get(ref_uid)
         if matched_series_info:
             seg_info["series_info"] = {
                 "series_folder_path": matched_series_info["series_folder_path"],
@@ -71,8 +172,7 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
             seg_info["series_info"] = None
     out_dir = os.path.dirname(os.path.abspath(prepared_json_path))
     out_path = os.path.join(out_dir, output_json)
-    with open(out_path, "w") as f:
-        json.dump(prepared_data, f, indent=4)
+    write_json(prepared_data, out_path)
     print(f"[2.4.1] Created {output_json} at: {out_path}")
     return out_path
 
@@ -80,36 +180,85 @@ def step_2_4_1_create_ready2nifti(prepared_json_path, study_series_json_path, ou
 # 2.4.2 - CREATE ORIGINAL CT/MRI NRRD
 # ----------------------------------------------------------------
 
+def pixel_dtype_from_header(ds):
+    """
+    dtype of ds.pixel_array for plain grayscale data, derived from BitsAllocated and
+    PixelRepresentation (int16 if they are missing).
+    """
+    bits = int(getattr(ds, "BitsAllocated", 16) or 16)
+    signed = int(getattr(ds, "PixelRepresentation", 1) or 0) == 1
+    return np.dtype(f"{'i' if signed else 'u'}{max(bits, 8) // 8}")
+
+# Transfer syntaxes whose Pixel Data is the raw little-endian sample array
+NATIVE_LITTLE_ENDIAN_SYNTAXES = {"1.2.840.10008.1.2", "1.2.840.10008.1.2.1"}
+
+def slice_pixels(ds):
+    """
+    2D pixel array of a single-frame grayscale slice.
+
+    Uncompressed little-endian Pixel Data is viewed directly with np.frombuffer, which
+    skips pydicom's pixel handler machinery (and its extra copy); unused high bits are
+    corrected the same way ds.pixel_array does. Anything else uses ds.pixel_array.
+    """
+    meta = getattr(ds, "file_meta", None)
+    syntax = str(getattr(meta, "TransferSyntaxUID", "")) if meta is not None else ""
+    bits = int(getattr(ds, "BitsAllocated", 0) or 0)
+    if (
+        syntax not in NATIVE_LITTLE_ENDIAN_SYNTAXES
+        or bits not in (8, 16, 32)
+        or int(getattr(ds, "SamplesPerPixel", 1) or 1) != 1
+        or int(getattr(ds, "NumberOfFrames", 1) or 1) != 1
+        or "PixelData" not in ds
+    ):
+        return ds.pixel_array
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    arr = np.frombuffer(
+        ds.PixelData, dtype=pixel_dtype_from_header(ds).newbyteorder("<"), count=rows * cols
+    ).reshape(rows, cols)
+    unused = bits - int(getattr(ds, "BitsStored", bits) or bits)
+    if unused > 0:
+        if arr.dtype.kind == "i":
+            arr = (arr << unused) >> unused  # sign-extend from BitsStored
+        else:
+            arr = arr & ((1 << (bits - unused)) - 1)
+    return arr
+
 def load_dicom_series(series_folder_path):
     """
     Loads a DICOM series from series_folder_path.
     Returns (volume_3d, affine, dims).
     """
-    import glob
     dcm_files = sorted(glob.glob(os.path.join(series_folder_path, "*.dcm")))
-    slices = []
-    for f in dcm_files:
-        ds = pydicom.dcmread(f, force=True)
-        slices.append(ds)
+    # read all slices in parallel (map keeps the file order); elements over 64 KB (the
+    # Pixel Data) are deferred and only read from the file when the slice is copied into
+    # the volume, so the listed Datasets hold headers only
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        slices = list(ex.map(lambda f: pydicom.dcmread(f, force=True, defer_size="64 KB"), dcm_files))
     if not slices:
         raise RuntimeError(f"No DICOM slices found in {series_folder_path}")
-    def sort_key(ds): return getattr(ds, "InstanceNumber", 0)
+    def sort_key(ds): return ds.get("InstanceNumber", 0)
     slices.sort(key=sort_key)
     sample_ds = slices[0]
     rows, cols = sample_ds.Rows, sample_ds.Columns
-    px_spacing = [1.0, 1.0]
-    slice_thick = 1.0
-    if hasattr(sample_ds, "PixelSpacing"):
-        px_spacing = [float(x) for x in sample_ds.PixelSpacing]
-    if hasattr(sample_ds, "SliceThickness"):
-        slice_thick = float(sample_ds.SliceThickness)
-    iop = [1, 0, 0, 0, 1, 0]
-    if hasattr(sample_ds, "ImageOrientationPatient"):
-        iop = [float(x) for x in sample_ds.ImageOrientationPatient]
+    # one lookup per tag (missing or empty elements fall back to the defaults)
+    px_spacing = [float(x) for x in (sample_ds.get("PixelSpacing") or [1.0, 1.0])]
+    slice_thick = float(sample_ds.get("SliceThickness") or 1.0)
+    iop = [float(x) for x in (sample_ds.get("ImageOrientationPatient") or [1, 0, 0, 0, 1, 0])]
     n_slices = len(slices)
-    volume_3d = np.zeros((rows, cols, n_slices), dtype=np.int16)
-    for idx, ds in enumerate(slices):
-        volume_3d[:, :, idx] = ds.pixel_array
+    # Fortran order: each slice is one contiguous block, and it is the layout nrrd.write
+    # stores (index_order="F"), so the volume is written without a transposed copy
+    volume_3d = np.empty((rows, cols, n_slices), dtype=np.int16, order="F")
+    slice_dtype = slice_pixels(sample_ds).dtype
+    sop_uid_list = [ds.get("SOPInstanceUID") for ds in slices]
+    def copy_slice(idx):
+        volume_3d[:, :, idx] = slice_pixels(slices[idx])
+        # drop the Dataset (and its Pixel Data) as soon as it is copied, so the series is
+        # not held in memory twice
+        slices[idx] = None
+    # decode/convert each slice straight into its block of the volume on the thread pool
+    # (NumPy copies and the pixel decoders release the GIL)
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        list(ex.map(copy_slice, range(n_slices)))
     row_cos = np.array(iop[0:3])
     col_cos = np.array(iop[3:6])
     slice_cos = np.cross(row_cos, col_cos)
@@ -119,77 +268,444 @@ def load_dicom_series(series_folder_path):
     affine[0:3,0] = row_cos * spacing[0]
     affine[0:3,1] = col_cos * spacing[1]
     affine[0:3,2] = slice_cos * spacing[2]
-    if hasattr(slices[0], "ImagePositionPatient"):
-        ipp = [float(x) for x in slices[0].ImagePositionPatient]
-        affine[0:3,3] = ipp
+    ipp = sample_ds.get("ImagePositionPatient")
+    if ipp:
+        affine[0:3,3] = [float(x) for x in ipp]
     dims = (rows, cols, n_slices)
+    # Remember the slice order and geometry for 2.4.3
+    SERIES_GEOMETRY_CACHE[os.path.abspath(series_folder_path)] = SeriesGeometry(
+        sop_uid_list=sop_uid_list,
+        shape=dims,
+        affine=affine,
+        dtype=slice_dtype
+    )
     return volume_3d, affine, dims
 
-def step_2_4_2_create_original_nrrd(ready2nifti_json_path, overwrite=False):
+# NRRD "type" field of each NumPy dtype the volumes and masks can have
+NRRD_TYPES = {
+    np.dtype(np.int8): "signed char", np.dtype(np.uint8): "uchar",
+    np.dtype(np.int16): "short", np.dtype(np.uint16): "ushort",
+    np.dtype(np.int32): "int", np.dtype(np.uint32): "uint",
+    np.dtype(np.float32): "float", np.dtype(np.float64): "double"
+}
+
+def probe_dims(series_folder_path):
+    """
+    (rows, cols, slices) of a DICOM series from the header of its first file and the
+    number of .dcm files, without reading the rest of the series.
+    """
+    dcm_files = sorted(glob.glob(os.path.join(series_folder_path, "*.dcm")))
+    if not dcm_files:
+        raise RuntimeError(f"No DICOM slices found in {series_folder_path}")
+    ds0 = pydicom.dcmread(dcm_files[0], force=True, stop_before_pixels=True, specific_tags=["Rows", "Columns"])
+    return (int(ds0.Rows), int(ds0.Columns), len(dcm_files))
+
+def create_series_nrrd(series_info, out_dir, overwrite=False, compress=False):
+    """
+    2.4.2 for one series: load the DICOM series of series_info and save it as
+    "<series_number>.nrrd" in out_dir (skipping an existing file with matching shape
+    unless overwrite is True).
+
+    Returns the SeriesGeometry of the series if it was read (so a worker process can
+    hand it back to the parent's SERIES_GEOMETRY_CACHE), else None.
+    """
+    series_number = series_info.get("series_number")
+    series_path = series_info.get("series_folder_path")
+    geometry_key = os.path.abspath(series_path)
+    nrrd_name = f"{series_number}.nrrd"
+    nrrd_path = os.path.join(out_dir, nrrd_name)
+    if os.path.exists(nrrd_path) and not overwrite:
+        try:
+            # the header alone gives the shape; the data block is never read
+            existing_shape = tuple(int(x) for x in nrrd.read_header(nrrd_path)["sizes"])
+            # series dims from the cache, or probed from one header and the file count
+            geometry = SERIES_GEOMETRY_CACHE.get(geometry_key)
+            series_dims = geometry.shape if geometry is not None else probe_dims(series_path)
+            if existing_shape == tuple(series_dims):
+                print(f"[2.4.2] Found existing {nrrd_name} with shape {existing_shape}, skipping creation.")
+                return SERIES_GEOMETRY_CACHE.get(geometry_key)
+        except (OSError, nrrd.NRRDError, KeyError, ValueError):
+            pass  # unreadable header or series; re-create the NRRD
+    try:
+        vol_3d, aff, dims = load_dicom_series(series_path)
+    except Exception as e:
+        print(f"Error loading DICOM series {series_number} from {series_path}: {e}")
+        return SERIES_GEOMETRY_CACHE.get(geometry_key)
+    # Build NRRD header from affine and dims.
+    # Convert affine to space directions and origin.
+    directions = [aff[0:3,0].tolist(), aff[0:3,1].tolist(), aff[0:3,2].tolist()]
+    origin = aff[0:3,3].tolist()
+    header = {
+        "space directions": directions,
+        "space origin": origin,
+        "sizes": dims,
+        "type": NRRD_TYPES[vol_3d.dtype],
+        "encoding": "gzip" if compress else "raw"
+    }
+    try:
+        # the volume is Fortran-ordered, so index_order="F" writes it without a transpose
+        nrrd.write(nrrd_path, vol_3d, header, compression_level=1, index_order="F")
+        print(f"[2.4.2] Created {nrrd_name} with shape {vol_3d.shape} at {nrrd_path}")
+    except Exception as e:
+        print(f"Error writing NRRD for series {series_number}: {e}")
+    return SERIES_GEOMETRY_CACHE.get(geometry_key)
+
+def step_2_4_2_create_original_nrrd(ready2nifti_json_path, overwrite=False, compress=False):
     """
     Reads Ready2Nifti_info.json, for each segmentation's series_info,
     loads the DICOM series, and creates a .nrrd file (e.g. "1.nrrd") in a folder named "NRRD".
 
     Skips creation if the file exists with matching shape unless overwrite is True.
+    The data is stored raw, or gzip-compressed (level 1) with compress=True.
     """
-    with open(ready2nifti_json_path, "r") as f:
-        data = json.load(f)
+    data = read_json(ready2nifti_json_path)
     seg_dict = data.get("selected_segmentations", {})
     base_dir = os.path.dirname(os.path.abspath(ready2nifti_json_path))
     out_dir = os.path.join(base_dir, "NRRD")
     os.makedirs(out_dir, exist_ok=True)
-    processed_series = {}
+    # Each referenced series once (several segmentations usually share one)
+    series_to_create = {}
     for seg_folder_name, seg_info in seg_dict.items():
         series_info = seg_info.get("series_info")
         if not series_info:
             continue
         series_number = series_info.get("series_number")
         series_path = series_info.get("series_folder_path")
+        if series_number in series_to_create:
+            continue
         if not series_path or not os.path.isdir(series_path):
             print(f"Skipping series {series_number} - invalid path {series_path}")
             continue
-        if series_number in processed_series:
-            continue
-        nrrd_name = f"{series_number}.nrrd"
-        nrrd_path = os.path.join(out_dir, nrrd_name)
-        if os.path.exists(nrrd_path) and not overwrite:
+        series_to_create[series_number] = series_info
+    series_infos = list(series_to_create.values())
+
+    # Series are independent (own DICOM folder, own output file), so they are
+    # processed in parallel worker processes
+    workers = min(PROCESS_WORKERS, len(series_infos))
+    if workers > 1:
+        with worker_pool(workers) as ex:
+            geometries = list(ex.map(
+                create_series_nrrd, series_infos, repeat(out_dir), repeat(overwrite), repeat(compress)
+            ))
+    else:
+        geometries = [create_series_nrrd(si, out_dir, overwrite, compress) for si in series_infos]
+    # Keep what the workers read for 2.4.3
+    for series_info, geometry in zip(series_infos, geometries):
+        if geometry is not None:
+            SERIES_GEOMETRY_CACHE[os.path.abspath(series_info["series_folder_path"])] = geometry
+
+# ----------------------------------------------------------------
+# 2.4.3 - CREATE SEGMENTATION NRRD
+# ----------------------------------------------------------------
+
+# Header tags load_sop_uid_order needs; pydicom skips every other element
+SERIES_HEADER_TAGS = [
+    "InstanceNumber", "SOPInstanceUID", "Rows", "Columns", "PixelSpacing", "SliceThickness",
+    "ImageOrientationPatient", "ImagePositionPatient", "BitsAllocated", "PixelRepresentation"
+]
+
+def load_sop_uid_order(series_path):
+    """Read the slice order and geometry (a SeriesGeometry) of the DICOM series in series_path."""
+    dcm_files = sorted(glob.glob(os.path.join(series_path, "*.dcm")))
+    if not dcm_files:
+        raise RuntimeError("No DICOMs found.")
+    # read the headers only (stop before Pixel Data, skip everything not listed), in parallel
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        slices = list(ex.map(
+            lambda f: pydicom.dcmread(f, force=True, stop_before_pixels=True, specific_tags=SERIES_HEADER_TAGS),
+            dcm_files
+        ))
+    slices.sort(key=lambda ds: ds.get("InstanceNumber", 0))
+    sample_ds = slices[0]
+    rows = sample_ds.Rows
+    cols = sample_ds.Columns
+    # one lookup per tag (missing or empty elements fall back to the defaults)
+    px_spacing = [float(x) for x in (sample_ds.get("PixelSpacing") or [1.0, 1.0])]
+    slice_thick = float(sample_ds.get("SliceThickness") or 1.0)
+    iop = [float(x) for x in (sample_ds.get("ImageOrientationPatient") or [1, 0, 0, 0, 1, 0])]
+    row_cos = np.array(iop[0:3])
+    col_cos = np.array(iop[3:6])
+    slice_cos = np.cross(row_cos, col_cos)
+    spacing = np.array([px_spacing[0], px_spacing[1], slice_thick], dtype=float)
+    aff = np.zeros((4,4), dtype=float)
+    aff[3,3] = 1.0
+    aff[0:3,0] = row_cos * spacing[0]
+    aff[0:3,1] = col_cos * spacing[1]
+    aff[0:3,2] = slice_cos * spacing[2]
+    ipp = sample_ds.get("ImagePositionPatient")
+    if ipp:
+        aff[0:3,3] = [float(x) for x in ipp]
+    sop_list = [ds.get("SOPInstanceUID") for ds in slices]
+    # the dtype pixel_array would have, from the header (no pixel decoding needed)
+    vol_dtype = pixel_dtype_from_header(sample_ds)
+    shape_ = (rows, cols, len(slices))
+    return SeriesGeometry(sop_uid_list=sop_list, shape=shape_, affine=aff, dtype=vol_dtype)
+
+def map_sop_uids_to_slices(geometry, frame_uids):
+    """
+    Slice index of each frame's ref_sop_uid in one vectorized lookup.
+
+    Every frame UID is found in the series' sorted UIDs (sop_uid_lookup()) with
+    np.searchsorted. Returns an int64 array with -1 for frames whose UID is not in
+    the series.
+    """
+    sorted_sop, order = sop_uid_lookup(geometry)
+    uids = np.array([str(u) for u in frame_uids])
+    if sorted_sop.size == 0 or uids.size == 0:
+        return np.full(uids.size, -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_sop, uids, side="right") - 1
+    pos_ok = np.maximum(pos, 0)
+    found = (pos >= 0) & (sorted_sop[pos_ok] == uids)
+    return np.where(found, order[pos_ok], -1)
+
+if njit is not None:
+    # Compiled on first use, not at import; cache=True keeps the machine code on disk,
+    # so only the first run pays the compile time
+    @njit(parallel=True, cache=True)
+    def _scatter_masks_kernel(out, frames, idx):
+        # out: (rows, cols, slices) volume; frames[k] goes to slice idx[k].
+        # Parallel over rows, so frames that hit the same slice are still
+        # written in order (the last one wins, as in the sequential loop).
+        for r in prange(out.shape[0]):
+            for k in range(idx.shape[0]):
+                s = idx[k]
+                for c in range(out.shape[1]):
+                    out[r, c, s] = frames[k, r, c]
+
+    @njit(parallel=True, cache=True)
+    def _scatter_packed_masks_kernel(out, packed, idx):
+        # Same as _scatter_masks_kernel, but frames are np.packbits rows (MSB first)
+        # of the row-major (rows, cols) mask, unpacked bit by bit while writing.
+        cols = out.shape[1]
+        for r in prange(out.shape[0]):
+            for k in range(idx.shape[0]):
+                s = idx[k]
+                for c in range(cols):
+                    bit = r * cols + c
+                    out[r, c, s] = (packed[k, bit >> 3] >> (7 - (bit & 7))) & 1
+
+def scatter_masks(out, frames, idx):
+    """
+    Write 2D masks into the slices of a 3D volume.
+
+    Parameters
+    ----------
+    out : np.ndarray
+        (rows, cols, slices) uint8 volume, written in place.
+    frames : np.ndarray
+        (n_frames, rows, cols) uint8 stack of masks.
+    idx : np.ndarray
+        int64 array of length n_frames; frames[k] is written to out[:, :, idx[k]].
+    """
+    if njit is not None:
+        _scatter_masks_kernel(out, frames, idx)
+    else:
+        for k in range(idx.shape[0]):
+            out[:, :, idx[k]] = frames[k]
+
+def scatter_packed_masks(out, packed, idx):
+    """
+    scatter_masks() for bit-packed masks: packed is the (n_frames, n_bytes) uint8 stack
+    of np.packbits-packed frames. They are unpacked as they are written (one frame at a
+    time without numba), so the masks never exist unpacked all at once.
+    """
+    if njit is not None:
+        _scatter_packed_masks_kernel(out, packed, idx)
+    else:
+        rows, cols = out.shape[0], out.shape[1]
+        for k in range(idx.shape[0]):
+            out[:, :, idx[k]] = np.unpackbits(packed[k], count=rows * cols).reshape(rows, cols)
+
+def frames_to_arrays(frames):
+    """
+    Structure-of-arrays view of the frame fields 2.4.3 uses, built in one pass.
+
+    Returns
+    -------
+    dict
+        "ref_sop_uid" (list), "segment_name" (str array), "has_pixels" (bool array) and
+        "pixel_shape" ((n_frames, 2) int64 array of the unpacked (rows, cols); 0 when a
+        frame has no pixel data).
+    """
+    n = len(frames)
+    arrays = {
+        "ref_sop_uid": [None] * n,
+        "segment_name": [None] * n,
+        "has_pixels": np.zeros(n, dtype=bool),
+        "pixel_shape": np.zeros((n, 2), dtype=np.int64),
+    }
+    for i, fr in enumerate(frames):
+        arrays["ref_sop_uid"][i] = fr.get("ref_sop_uid", None)
+        arrays["segment_name"][i] = str(fr.get("segment_name", "UnknownSEG"))
+        px = fr.get("pixel_data")
+        if px is not None:
+            arrays["has_pixels"][i] = True
+            shape = fr.get("pixel_shape") or px.shape
+            arrays["pixel_shape"][i] = shape[:2]
+    arrays["segment_name"] = np.array(arrays["segment_name"], dtype=str)
+    return arrays
+
+def stack_masks(frames, frame_ids):
+    """
+    The pixel_data of frames[frame_ids] as one contiguous stack: (n, rows, cols) uint8
+    masks, or (n, n_bytes) rows for bit-packed frames (kept packed).
+    """
+    return np.stack([frames[k]["pixel_data"] for k in frame_ids]).astype(np.uint8, copy=False)
+
+def create_seg_nrrd(seg_folder_name, seg_info, out_dir, overwrite=False, geometry=None, compress=False):
+    """
+    2.4.3 for one segmentation: build a 3D mask per segment_name from the frames of its
+    pkl_file and save each as "{series_number}_ON_{segment_name}__FN_{seg_folder_name}.seg.nrrd"
+    in out_dir. geometry is the SeriesGeometry of the referenced series (loaded here when None).
+    """
+    pkl_file = seg_info.get("pkl_file")
+    series_info = seg_info.get("series_info", {})
+    if not pkl_file or not os.path.exists(pkl_file):
+        print(f"Skipping {seg_folder_name} - pkl_file missing or not found.")
+        return
+    series_number = series_info.get("series_number")
+    series_path = series_info.get("series_folder_path")
+    if not series_number or not series_path or not os.path.isdir(series_path):
+        print(f"Skipping {seg_folder_name} - invalid series info.")
+        return
+
+    seg_data = load_pickle(pkl_file)
+    frames = seg_data.get("frames", [])
+    is_packed = seg_data.get("pixel_encoding") == "packbits"
+    if geometry is None:
+        try:
+            geometry = load_series_geometry(series_path)
+        except Exception as e:
+            print(f"Unable to load series info for {series_number}: {e}")
+            return
+
+    sop_uid_list, shape_, aff_, vol_dtype_ = (
+        geometry.sop_uid_list, geometry.shape, geometry.affine, geometry.dtype
+    )
+    # Map every frame's ref_sop_uid to its slice index at once
+    arrays = frames_to_arrays(frames)
+    frame_slices = map_sop_uids_to_slices(geometry, arrays["ref_sop_uid"])
+    placeable = np.flatnonzero(arrays["has_pixels"] & (frame_slices >= 0))
+
+    # Group the placeable frames by segment_name (groups in order of first appearance,
+    # frames in their original order); packed frames stay packed until they are placed
+    segment_groups = []
+    if placeable.size:
+        names, first, inverse = np.unique(arrays["segment_name"][placeable], return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[order] = np.arange(len(names))
+        group_of = rank[inverse]
+        grouped = placeable[np.argsort(group_of, kind="stable")]
+        bounds = np.cumsum(np.bincount(group_of, minlength=len(names)))[:-1]
+        segment_groups = list(zip(names[order].tolist(), np.split(grouped, bounds)))
+
+    for seg_name, frame_ids in segment_groups:
+        nii_name = f"{series_number}_ON_{seg_name}__FN_{seg_folder_name}.seg.nrrd"
+        nii_path = os.path.join(out_dir, nii_name)
+        # Skip an existing file of the series shape before building its mask (the shape
+        # comes from the NRRD header; the data block is never read)
+        if os.path.exists(nii_path) and not overwrite:
             try:
-                import nrrd
-                header_existing, data_existing = nrrd.read(nrrd_path)
-                if data_existing.shape == tuple(load_dicom_series(series_path)[2]):
-                    processed_series[series_number] = nrrd_path
-                    print(f"[2.4.2] Found existing {nrrd_name} with shape {data_existing.shape}, skipping creation.")
+                existing_shape = tuple(int(x) for x in nrrd.read_header(nii_path)["sizes"])
+                if existing_shape == tuple(shape_):
+                    print(f"[2.4.3] Found existing {nii_name} with shape {existing_shape}, skipping creation.")
                     continue
-            except Exception as e:
+            except:
                 pass
-        try:
-            vol_3d, aff, dims = load_dicom_series(series_path)
-        except Exception as e:
-            print(f"Error loading DICOM series {series_number} from {series_path}: {e}")
-            continue
-        # Build NRRD header from affine and dims.
-        # Convert affine to space directions and origin.
-        directions = [aff[0:3,0].tolist(), aff[0:3,1].tolist(), aff[0:3,2].tolist()]
-        origin = aff[0:3,3].tolist()
+
+        # Check all the frame shapes against the series (rows, cols) at once; frames
+        # that do not fit are skipped
+        fits = (arrays["pixel_shape"][frame_ids] == shape_[:2]).all(axis=1)
+        for k in frame_ids[~fits]:
+            print(f"WARNING: mismatch shape in {seg_folder_name}, segment {seg_name}, slice {frame_slices[k]}")
+        frame_ids = frame_ids[fits]
+
+        # Fortran-ordered volume (the layout nrrd.write stores), with the group's frames
+        # written into their slices in one scatter (a later frame for the same slice
+        # replaces an earlier one); bit-packed masks are unpacked as they are written
+        mask_3d = np.zeros(shape_, dtype=np.uint8, order="F")
+        if frame_ids.size:
+            scatter = scatter_packed_masks if is_packed else scatter_masks
+            scatter(mask_3d, stack_masks(frames, frame_ids), frame_slices[frame_ids])
+        # Build custom header with segmentation metadata
         header = {
-            "space directions": directions,
-            "space origin": origin,
-            "sizes": dims,
-            "type": "short"
+            "space directions": [aff_[0:3,0].tolist(), aff_[0:3,1].tolist(), aff_[0:3,2].tolist()],
+            "space origin": aff_[0:3,3].tolist(),
+            "sizes": shape_,
+            "type": NRRD_TYPES[mask_3d.dtype],
+            "encoding": "gzip" if compress else "raw",
+            # Custom fields for segmentation
+            "Segmentation_SourceRepresentation": "Binary labelmap",
+            "Segmentation_ContainedRepresentationNames": "Binary labelmap"
         }
+        # For this segment, we add fields with index 0 (since each file is one segment)
+        # You could customize these further.
+        # For extent, compute nonzero bounds from the per-axis any() projections
+        # (no index arrays the size of the foreground).
+        bounds = []
+        for axis in range(3):
+            occupied = mask_3d.any(axis=tuple(a for a in range(3) if a != axis))
+            if not occupied.any():
+                bounds = [0] * 6
+                break
+            bounds += [int(occupied.argmax()), int(occupied.size - 1 - occupied[::-1].argmax())]
+        extent = " ".join(str(b) for b in bounds)
+        header.update({
+            "Segment0_Name": seg_name,
+            "Segment0_NameAutoGenerated": "0",
+            "Segment0_Color": "0.5 0.5 0.5",  # default; update if you have color info
+            "Segment0_ColorAutoGenerated": "1",
+            "Segment0_Extent": extent,
+            "Segment0_Layer": "0",
+            "Segment0_LabelValue": "1"
+        })
         try:
-            import nrrd
-            nrrd.write(nrrd_path, vol_3d, header)
-            processed_series[series_number] = nrrd_path
-            print(f"[2.4.2] Created {nrrd_name} with shape {vol_3d.shape} at {nrrd_path}")
+            nrrd.write(nii_path, mask_3d, header, compression_level=1, index_order="F")
+            print(f"[2.4.3] Created {nii_name} with shape {mask_3d.shape}")
         except Exception as e:
-            print(f"Error writing NRRD for series {series_number}: {e}")
+            print(f"Error writing NRRD segmentation for {seg_folder_name}, segment {seg_name}: {e}")
 
-# ----------------------------------------------------------------
-# 2.4.3 - CREATE SEGMENTATION NRRD
-# ----------------------------------------------------------------
+def create_seg_nrrds(seg_dict, names, out_dir, overwrite=False, compress=False):
+    """
+    Run create_seg_nrrd for the segmentations seg_dict[name] for name in names,
+    in parallel worker processes.
+    """
+    # The slice order of each referenced series is loaded once, here: load_series_geometry()
+    # caches it per series (and reuses what 2.4.2 read); failures are reported per
+    # segmentation by create_seg_nrrd
+    geometries = []
+    for seg_folder_name in names:
+        series_info = seg_dict[seg_folder_name].get("series_info") or {}
+        series_path = series_info.get("series_folder_path")
+        geometry = None
+        if series_path and os.path.isdir(series_path):
+            try:
+                geometry = load_series_geometry(series_path)
+                sop_uid_lookup(geometry)  # build it once here rather than in every worker
+            except Exception:
+                geometry = None
+        geometries.append(geometry)
 
-def step_2_4_3_create_seg_nrrd(ready2nifti_json_path, overwrite=False):
+    # Segmentations are independent (own pkl file, own output files), so they are
+    # processed in parallel worker processes
+    workers = min(PROCESS_WORKERS, len(names))
+    if workers > 1:
+        with worker_pool(workers) as ex:
+            list(ex.map(
+                create_seg_nrrd,
+                names,
+                [seg_dict[n] for n in names],
+                repeat(out_dir),
+                repeat(overwrite),
+                geometries,
+                repeat(compress)
+            ))
+    else:
+        for seg_folder_name, geometry in zip(names, geometries):
+            create_seg_nrrd(seg_folder_name, seg_dict[seg_folder_name], out_dir, overwrite, geometry, compress)
+
+def step_2_4_3_create_seg_nrrd(ready2nifti_json_path, overwrite=False, compress=False):
     """
     For each selected segmentation in Ready2Nifti_info.json, we:
       - Load its pkl_file with frames[].
@@ -198,141 +714,15 @@ def step_2_4_3_create_seg_nrrd(ready2nifti_json_path, overwrite=False):
       - For each unique segment_name, build a 3D mask array.
       - Save as "{series_number}_ON_{segment_name}__FN_{seg_folder_name}.seg.nrrd" in the "NRRD" folder.
       - Additional custom header fields are added to store segmentation metadata.
+    The masks are stored raw, or gzip-compressed (level 1) with compress=True.
     """
-    with open(ready2nifti_json_path, "r") as f:
-        data = json.load(f)
+    data = read_json(ready2nifti_json_path)
     seg_dict = data.get("selected_segmentations", {})
     base_dir = os.path.dirname(os.path.abspath(ready2nifti_json_path))
     out_dir = os.path.join(base_dir, "NRRD")
     os.makedirs(out_dir, exist_ok=True)
 
-    from collections import defaultdict
-    series_sop_uids_cache = {}
-    def load_sop_uid_order(series_path):
-        import glob
-        dcm_files = sorted(glob.glob(os.path.join(series_path, "*.dcm")))
-        if not dcm_files:
-            raise RuntimeError("No DICOMs found.")
-        slices = []
-        for f in dcm_files:
-            ds = pydicom.dcmread(f, force=True)
-            slices.append(ds)
-        slices.sort(key=lambda ds: getattr(ds, "InstanceNumber", 0))
-        sop_list = []
-        rows = slices[0].Rows
-        cols = slices[0].Columns
-        px_spacing = getattr(slices[0], "PixelSpacing", [1.0, 1.0])
-        slice_thick = getattr(slices[0], "SliceThickness", 1.0)
-        iop = getattr(slices[0], "ImageOrientationPatient", [1,0,0,0,1,0])
-        row_cos = np.array(iop[0:3])
-        col_cos = np.array(iop[3:6])
-        slice_cos = np.cross(row_cos, col_cos)
-        spacing = np.array([px_spacing[0], px_spacing[1], slice_thick], dtype=float)
-        aff = np.zeros((4,4), dtype=float)
-        aff[3,3] = 1.0
-        aff[0:3,0] = row_cos * spacing[0]
-        aff[0:3,1] = col_cos * spacing[1]
-        aff[0:3,2] = slice_cos * spacing[2]
-        if hasattr(slices[0], "ImagePositionPatient"):
-            ipp = [float(x) for x in slices[0].ImagePositionPatient]
-            aff[0:3,3] = ipp
-        for s in slices:
-            sop_list.append(getattr(s, "SOPInstanceUID", None))
-        test_arr = slices[0].pixel_array
-        vol_dtype = test_arr.dtype
-        shape_ = (rows, cols, len(slices))
-        return sop_list, shape_, aff, vol_dtype
-
-    for seg_folder_name, seg_info in seg_dict.items():
-        pkl_file = seg_info.get("pkl_file")
-        series_info = seg_info.get("series_info", {})
-        if not pkl_file or not os.path.exists(pkl_file):
-            print(f"Skipping {seg_folder_name} - pkl_file missing or not found.")
-            continue
-        series_number = series_info.get("series_number")
-        series_path = series_info.get("series_folder_path")
-        if not series_number or not series_path or not os.path.isdir(series_path):
-            print(f"Skipping {seg_folder_name} - invalid series info.")
-            continue
-
-        with open(pkl_file, "rb") as pf:
-            seg_data = pickle.load(pf)
-        frames = seg_data.get("frames", [])
-        if series_number not in series_sop_uids_cache:
-            try:
-                sop_uid_list, shape_, aff_, vol_dtype_ = load_sop_uid_order(series_path)
-                series_sop_uids_cache[series_number] = (sop_uid_list, shape_, aff_, vol_dtype_)
-            except Exception as e:
-                print(f"Unable to load series info for {series_number}: {e}")
-                continue
-
-        sop_uid_list, shape_, aff_, vol_dtype_ = series_sop_uids_cache[series_number]
-        sop_uid_to_index = {suid: i for i, suid in enumerate(sop_uid_list)}
-
-        from collections import defaultdict
-        segment_frames_map = defaultdict(list)
-        for fr in frames:
-            seg_name = fr.get("segment_name", "UnknownSEG")
-            sopid = fr.get("ref_sop_uid", None)
-            frame_2d = fr.get("pixel_data", None)
-            if sopid in sop_uid_to_index and frame_2d is not None:
-                slice_index = sop_uid_to_index[sopid]
-                segment_frames_map[seg_name].append((slice_index, frame_2d))
-
-        for seg_name, slices_info in segment_frames_map.items():
-            mask_3d = np.zeros(shape_, dtype=np.uint8)
-            for slice_idx, mask_2d in slices_info:
-                if mask_2d.shape[0] == shape_[0] and mask_2d.shape[1] == shape_[1]:
-                    mask_3d[:, :, slice_idx] = mask_2d
-                else:
-                    print(f"WARNING: mismatch shape in {seg_folder_name}, segment {seg_name}, slice {slice_idx}")
-            nii_name = f"{series_number}_ON_{seg_name}__FN_{seg_folder_name}.seg.nrrd"
-            nii_path = os.path.join(out_dir, nii_name)
-            if os.path.exists(nii_path) and not overwrite:
-                try:
-                    import nrrd
-                    header_existing, data_existing = nrrd.read(nii_path)
-                    if tuple(data_existing.shape) == shape_:
-                        print(f"[2.4.3] Found existing {nii_name} with shape {data_existing.shape}, skipping creation.")
-                        continue
-                except:
-                    pass
-
-            # Build custom header with segmentation metadata
-            header = {
-                "space directions": [aff_[0:3,0].tolist(), aff_[0:3,1].tolist(), aff_[0:3,2].tolist()],
-                "space origin": aff_[0:3,3].tolist(),
-                "sizes": shape_,
-                "type": "uchar",
-                # Custom fields for segmentation
-                "Segmentation_SourceRepresentation": "Binary labelmap",
-                "Segmentation_ContainedRepresentationNames": "Binary labelmap"
-            }
-            # For this segment, we add fields with index 0 (since each file is one segment)
-            # You could customize these further.
-            # For extent, compute nonzero bounds.
-            nz = np.nonzero(mask_3d)
-            if nz[0].size > 0:
-                extent = f"{int(np.min(nz[0]))} {int(np.max(nz[0]))} " \
-                         f"{int(np.min(nz[1]))} {int(np.max(nz[1]))} " \
-                         f"{int(np.min(nz[2]))} {int(np.max(nz[2]))}"
-            else:
-                extent = "0 0 0 0 0 0"
-            header.update({
-                "Segment0_Name": seg_name,
-                "Segment0_NameAutoGenerated": "0",
-                "Segment0_Color": "0.5 0.5 0.5",  # default; update if you have color info
-                "Segment0_ColorAutoGenerated": "1",
-                "Segment0_Extent": extent,
-                "Segment0_Layer": "0",
-                "Segment0_LabelValue": "1"
-            })
-            try:
-                import nrrd
-                nrrd.write(nii_path, mask_3d, header)
-                print(f"[2.4.3] Created {nii_name} with shape {mask_3d.shape}")
-            except Exception as e:
-                print(f"Error writing NRRD segmentation for {seg_folder_name}, segment {seg_name}: {e}")
+    create_seg_nrrds(seg_dict, list(seg_dict), out_dir, overwrite, compress)
 
 # ----------------------------------------------------------------
 # Main script combining the three steps
@@ -358,11 +748,11 @@ def main():
         output_json="Ready2Nifti_info.json"
     )
 
-    # Step 2.4.2
-    step_2_4_2_create_original_nrrd(ready2nifti_json_path=ready2nifti_path, overwrite=False)
+    # Step 2.4.2 (pass compress=True to gzip the NRRD data)
+    step_2_4_2_create_original_nrrd(ready2nifti_json_path=ready2nifti_path, overwrite=False, compress=False)
 
     # Step 2.4.3
-    step_2_4_3_create_seg_nrrd(ready2nifti_json_path=ready2nifti_path, overwrite=False)
+    step_2_4_3_create_seg_nrrd(ready2nifti_json_path=ready2nifti_path, overwrite=False, compress=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file